@@ -0,0 +1,66 @@
+# age_profiles.py
+
+# 町ごとの年齢構成（5歳階級 × 性別）をNumPy配列にまとめたもの
+# データセットごとに一度だけ作成してキャッシュし、棒グラフの更新時は町名から行番号を引いて1行取り出すだけにする
+
+import numpy as np  # 数値配列を扱うライブラリ
+from data_loader import get_derived
+
+# 5歳階級のラベルと、人口データ（列名の加工後）の列名の対応
+AGE_BINS = [
+    ('0-4', '０～４'), ('5-9', '５～９'), ('10-14', '１０～１４'), ('15-19', '１５～１９'),
+    ('20-24', '２０～２４'), ('25-29', '２５～２９'), ('30-34', '３０～３４'), ('35-39', '３５～３９'),
+    ('40-44', '４０～４４'), ('45-49', '４５～４９'), ('50-54', '５０～５４'), ('55-59', '５５～５９'),
+    ('60-64', '６０～６４'), ('65-69', '６５～６９'), ('70-74', '７０～７４'), ('75以上', '７５以上'),
+]
+AGE_LABELS = [label for label, _ in AGE_BINS]
+
+# 性別と、人口データの列名の接頭辞の対応（配列の3番目の軸の並び順）
+SEXES = [('total', ''), ('male', '男'), ('female', '女')]
+SEX_INDEX = {sex: i for i, (sex, _) in enumerate(SEXES)}
+
+def age_columns(sex='total'):
+    prefix = dict(SEXES)[sex]
+    return [prefix + column for _, column in AGE_BINS]
+
+def _build_age_profiles(data):
+    # matrix: (町の数, 年齢階級の数, 性別の数) の整数配列。町名がないなど人口データと結合できなかった行は0
+    matrix = np.zeros((len(data), len(AGE_BINS), len(SEXES)), dtype=np.int32)
+    for s, (sex, _) in enumerate(SEXES):
+        columns = age_columns(sex)
+        missing = [col for col in columns if col not in data.columns]
+        if missing:
+            raise KeyError(f"年齢別人口の列がデータに存在しません: {missing}")
+        matrix[:, :, s] = data[columns].fillna(0).to_numpy()
+    # 町名 → 行番号（同じ町名が複数ある場合は最初の行）
+    town_index = {}
+    for row, name in enumerate(data['town_name'].tolist()):
+        if isinstance(name, str):
+            town_index.setdefault(name, row)
+    return {'matrix': matrix, 'town_index': town_index}
+
+def age_profiles(city):
+    # {'matrix': 町×年齢階級×性別の配列, 'town_index': 町名→行番号}。データセットごとにキャッシュされる
+    return get_derived(city, 'age_profiles', _build_age_profiles)
+
+def town_profile(city, town_name):
+    # 町の年齢階級 × 性別の人口（見つからない場合は None）
+    profiles = age_profiles(city)
+    row = profiles['town_index'].get(town_name)
+    if row is None:
+        return None
+    return profiles['matrix'][row]
+
+def selection_rows(city, town_names):
+    # 町名のリストを age_profiles の行番号の配列にする（見つからない町と重複は除く）
+    town_index = age_profiles(city)['town_index']
+    rows = [town_index[name] for name in town_names if name in town_index]
+    return np.unique(np.asarray(rows, dtype=np.intp))
+
+def aggregate_profile(city, town_names):
+    # 複数の町の年齢階級 × 性別の人口の合計と、合計した町の数（見つかった町がない場合は (None, 0)）
+    # 町×年齢階級×性別の配列から選択した行を取り出し、一度の集計で合計する
+    rows = selection_rows(city, town_names)
+    if len(rows) == 0:
+        return None, 0
+    return age_profiles(city)['matrix'][rows].sum(axis=0, dtype=np.int64), len(rows)
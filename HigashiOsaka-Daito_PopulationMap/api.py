@@ -0,0 +1,287 @@
+# api.py
+
+# 町ごとの統計を返すデータAPI（Flaskのブループリント）
+# 画面と同じメモリ上のデータセット・派生データから、JSON・CSV・NDJSON で返す。
+# ETag と Last-Modified は元データのファイルの状態から求めるので、データを差し替えるまでは
+# 条件付きリクエスト（If-None-Match / If-Modified-Since）に 304 を返す。gzip に対応したクライアントには圧縮して返す
+#
+# エンドポイント（<city> は daitou や daitou+higashiosaka）:
+#   /api/cities                                  市区町村の一覧
+#   /api/cities/<city>/variables                 変数の一覧
+#   /api/cities/<city>/towns?offset=0&limit=100&variables=population_total,age_20_39   町ごとの値（ページ分割）
+#   /api/cities/<city>/variables/<variable>?year=2020                                  変数の町ごとの値
+#   /api/cities/<city>/towns/<town>/profile?year=2020                                  町の年齢構成
+#   /api/cities/<city>/export.csv?variables=... / export.ndjson                        全町の書き出し（逐次送信）
+
+import csv
+import gzip
+import hashlib
+import io
+import json
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np  # 数値配列を扱うライブラリ
+from flask import Blueprint, Response, request, abort, jsonify
+from data_loader import get_derived, discover_municipalities, resolve_city, city_signature
+from age_profiles import AGE_LABELS, SEXES, age_profiles
+from bands import build_variable_options, variable_values, variable_label
+from time_series import city_years, year_cube, year_values
+
+# レスポンスの形式を変えたら上げること（ETagが変わり、クライアントのキャッシュが無効になる）
+API_VERSION = 1
+
+# 町の一覧の1ページの件数（既定と上限）
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# この大きさ以上のレスポンスを gzip で圧縮する
+GZIP_MIN_BYTES = 1024
+
+# 書き出し（export）で一度に送る行数
+EXPORT_BATCH_ROWS = 200
+
+# 変数を指定しない場合に町の一覧で返す変数
+DEFAULT_TOWN_VARIABLES = ['population_total', 'male_total', 'female_total']
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+class _NotModified(Exception):
+    pass
+
+def _city_or_404(value):
+    city = resolve_city(value)
+    if city is None:
+        abort(404, description=f"unknown city: {value}")
+    return city
+
+def _validators(city):
+    # 元データのファイルの状態と、リクエストのURL（パス・クエリ）から ETag と Last-Modified を求める
+    # city が None（市区町村の一覧）の場合は、見つかったすべての市区町村の元データのファイルの状態を使う
+    # （年次の人口データのファイルを追加・差し替えた場合も一覧の年が変わるため）
+    if city:
+        files = city_signature(city)
+        signature = files
+    else:
+        municipalities = discover_municipalities()
+        files = tuple(entries for name in municipalities for entries in city_signature(name))
+        signature = (tuple(sorted(municipalities.items())), files)
+    digest = hashlib.sha256(repr((API_VERSION, signature, request.full_path)).encode('utf-8')).hexdigest()[:32]
+    mtimes = [mtime for entries in files for _, mtime, _ in entries]
+    last_modified = (datetime.fromtimestamp(max(mtimes) / 1e9, tz=timezone.utc).replace(microsecond=0)
+                     if mtimes else None)
+    return digest, last_modified
+
+def _check_conditional(etag, last_modified):
+    # クライアントが同じデータを持っていれば、値を計算する前に 304 を返す
+    if request.if_none_match and request.if_none_match.contains_weak(etag):
+        raise _NotModified()
+    if not request.if_none_match and last_modified is not None and request.if_modified_since is not None:
+        if last_modified <= request.if_modified_since:
+            raise _NotModified()
+
+def _accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '').lower()
+
+def _headers(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _json(payload, etag, last_modified):
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    if _accepts_gzip() and len(body) >= GZIP_MIN_BYTES:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return _headers(response, etag, last_modified)
+
+def _gzip_stream(chunks):
+    # 逐次送信する本文を、送るたびに圧縮する（全体をメモリに溜めない）
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _stream(chunks, mimetype, etag, last_modified, filename):
+    chunks = (chunk.encode('utf-8') for chunk in chunks)
+    response = Response(_gzip_stream(chunks) if _accepts_gzip() else chunks, mimetype=mimetype)
+    if _accepts_gzip():
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return _headers(response, etag, last_modified)
+
+def _value(v):
+    # NaN は null として、整数値は小数点なしで返す
+    if np.isnan(v):
+        return None
+    return int(v) if float(v).is_integer() else float(v)
+
+def _year_arg(city):
+    year = request.args.get('year', type=int)
+    if year is not None and year not in city_years(city):
+        abort(404, description=f"no population data for {year}")
+    return year
+
+def _variables_arg(default):
+    value = request.args.get('variables')
+    return [v for v in value.split(',') if v] if value else list(default)
+
+def _build_town_rows(city):
+    town_index = age_profiles(city)['town_index']
+    rows = np.fromiter(town_index.values(), dtype=np.intp, count=len(town_index))
+    order = np.argsort(rows)
+    names = np.array(list(town_index), dtype=object)
+    return rows[order], names[order].tolist()
+
+def _town_rows(city):
+    # (行番号の配列, 町名のリスト)。町名ごとに1行（同じ町が複数の行に分かれている場合は最初の行）で、データの行順
+    return get_derived(city, 'api_town_rows', lambda data: _build_town_rows(city))
+
+def _values(city, variable, year):
+    try:
+        return variable_values(city, variable) if year is None else year_values(city, variable, year)
+    except (KeyError, ValueError) as e:
+        abort(400, description=f"unknown variable: {variable} ({e})")
+
+def _columns(city, variables, year, rows):
+    return {variable: _values(city, variable, year)[rows] for variable in variables}
+
+@api.errorhandler(_NotModified)
+def _not_modified(_):
+    return Response(status=304)
+
+@api.errorhandler(400)
+@api.errorhandler(404)
+def _error(e):
+    return jsonify(error=e.description), e.code
+
+@api.route('/cities')
+def cities():
+    etag, last_modified = _validators(None)
+    _check_conditional(etag, last_modified)
+    payload = [{'name': name, 'display_name': display, 'years': city_years(name)}
+               for name, display in discover_municipalities().items()]
+    return _json({'cities': payload}, etag, last_modified)
+
+@api.route('/cities/<city>/variables')
+def variables(city):
+    city = _city_or_404(city)
+    etag, last_modified = _validators(city)
+    _check_conditional(etag, last_modified)
+    options = build_variable_options()
+    payload = [{'name': name, 'label': label} for label, name in options.items()]
+    return _json({'city': city, 'years': city_years(city), 'variables': payload}, etag, last_modified)
+
+@api.route('/cities/<city>/towns')
+def towns(city):
+    city = _city_or_404(city)
+    etag, last_modified = _validators(city)
+    _check_conditional(etag, last_modified)
+    year = _year_arg(city)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(MAX_PAGE_SIZE, max(1, request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)))
+    rows, names = _town_rows(city)
+    page_rows, page_names = rows[offset:offset + limit], names[offset:offset + limit]
+    columns = _columns(city, _variables_arg(DEFAULT_TOWN_VARIABLES), year, page_rows)
+    items = [dict({'town_name': name}, **{variable: _value(values[i]) for variable, values in columns.items()})
+             for i, name in enumerate(page_names)]
+    next_offset = offset + limit if offset + limit < len(names) else None
+    return _json({'city': city, 'year': year, 'total': len(names), 'offset': offset, 'limit': limit,
+                  'next_offset': next_offset, 'towns': items}, etag, last_modified)
+
+@api.route('/cities/<city>/variables/<variable>')
+def variable_vector(city, variable):
+    city = _city_or_404(city)
+    etag, last_modified = _validators(city)
+    _check_conditional(etag, last_modified)
+    year = _year_arg(city)
+    rows, names = _town_rows(city)
+    values = _values(city, variable, year)[rows]
+    return _json({'city': city, 'variable': variable, 'label': variable_label(variable), 'year': year,
+                  'towns': names, 'values': [_value(v) for v in values]}, etag, last_modified)
+
+@api.route('/cities/<city>/towns/<town>/profile')
+def town_profile(city, town):
+    city = _city_or_404(city)
+    etag, last_modified = _validators(city)
+    _check_conditional(etag, last_modified)
+    year = _year_arg(city)
+    row = age_profiles(city)['town_index'].get(town)
+    if row is None:
+        abort(404, description=f"unknown town: {town}")
+    if year is None:
+        profile = age_profiles(city)['matrix'][row]
+    else:
+        cube = year_cube(city)
+        if not cube['present'][row, cube['year_index'][year]]:
+            abort(404, description=f"no population data for {town} in {year}")
+        profile = cube['cube'][row, cube['year_index'][year]]
+    payload = {'city': city, 'town_name': town, 'year': year, 'age_groups': AGE_LABELS}
+    for s, (sex, _) in enumerate(SEXES):
+        payload[sex] = profile[:, s].tolist()
+    return _json(payload, etag, last_modified)
+
+def _export_rows(city, variables, year):
+    # (見出し, 行の反復子)。値の配列は先に求めておき、行は送るときに1行ずつ作る
+    rows, names = _town_rows(city)
+    columns = _columns(city, variables, year, rows)
+    header = ['town_name'] + variables
+
+    def iterate():
+        for i, name in enumerate(names):
+            yield [name] + [_value(columns[variable][i]) for variable in variables]
+    return header, iterate()
+
+def _batches(items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= EXPORT_BATCH_ROWS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+@api.route('/cities/<city>/export.<fmt>')
+def export(city, fmt):
+    if fmt not in ('csv', 'ndjson'):
+        abort(404, description=f"unknown format: {fmt}")
+    city = _city_or_404(city)
+    etag, last_modified = _validators(city)
+    _check_conditional(etag, last_modified)
+    year = _year_arg(city)
+    variables = _variables_arg(build_variable_options().values())
+    header, rows = _export_rows(city, variables, year)
+    filename = f"{city}{'_' + str(year) if year else ''}.{fmt}"
+
+    if fmt == 'ndjson':
+        def generate():
+            for batch in _batches(rows):
+                yield ''.join(json.dumps(dict(zip(header, row)), ensure_ascii=False) + '\n' for row in batch)
+        return _stream(generate(), 'application/x-ndjson', etag, last_modified, filename)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # Excelで文字化けしないようにBOMを付ける
+        writer.writerow(header)
+        yield '\ufeff' + buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        for batch in _batches(rows):
+            writer.writerows(['' if v is None else v for v in row] for row in batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    return _stream(generate(), 'text/csv', etag, last_modified, filename)
+
+def register_api(server):
+    # Dashの土台のFlaskサーバーにデータAPIを追加する
+    server.register_blueprint(api)
+    return server
@@ -1,28 +1,13 @@
 # app.p
 
-from dash import Dash  # Dashフレームワークをインポート。Webアプリケーションの作成に使用される
 import webbrowser       # デフォルトのWebブラウザを操作するためのモジュール
 from threading import Timer  # スレッドを使用して時間ベースの操作を可能にするモジュール
 import logging          # ログを出力するためのモジュール。デバッグや問題のトラッキングに役立つ
 import socket           # ネットワーク操作用モジュール。IPアドレスやポートの管理に利用可能
+import os               # 環境変数の読み込みに使用
 
-# loggingモジュールを使ってログの出力形式とレベル設定
-# logging.DEBUGでデバッグ用の詳細なログを出力
-# format='%(levelname)s:%(message)s'でログのフォーマット指定
-logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:%(message)s')
-
-# Dashアプリ全体を管理する土台を作成
-app = Dash(__name__)
-
-# 他のファイルからlayoutとcallbacksをインポート
-from layout import layout
-from callbacks import register_callbacks
-
-# アプリのレイアウトを設定
-app.layout = layout
-
-# コールバック関数の登録
-register_callbacks(app)
+# Dashアプリの作成処理（ログの設定を含む）は app_factory.py にある
+from app_factory import create_app
 
 # defでget_local_ipという関数を作成
 # hostnameにsocketモジュールでgethostname()関数を使いコンピュータ名を格納
@@ -34,8 +19,10 @@ def get_local_ip():
 # サーバー起動設定
 # このファイルが直接実行されたときだけ処理を実行するという条件。他ファイルからのインポート無効
 if __name__ == '__main__':
+    # 開発用サーバーで使うアプリを作成
+    app = create_app()
     # ポート番号を設定
-    port = 8050
+    port = int(os.environ.get('POPMAP_PORT', '8050'))
     # さっき作成した関数を使いIPアドレスを格納
     local_ip = get_local_ip()
     # Timerモジュールで1秒後に実行。webbrowserモジュールでwebブラウザで指定したURLを開く
@@ -0,0 +1,56 @@
+# app_factory.py
+
+# Dashアプリの作成（レイアウト・コールバック・エンドポイントの登録）
+# 開発用サーバー（app.py）、本番用のエントリーポイント（wsgi.py）、benchmark.py から呼び出す。
+# インポートしただけではアプリを作成しない（wsgi.py を読み込むgunicornの親プロセスでアプリが二重に作られないように）
+
+from dash import Dash  # Dashフレームワークをインポート。Webアプリケーションの作成に使用される
+import logging          # ログを出力するためのモジュール。デバッグや問題のトラッキングに役立つ
+import os               # 環境変数の読み込みに使用
+
+# loggingモジュールを使ってログの出力形式とレベル設定
+# 環境変数 POPMAP_LOG_LEVEL でレベルを指定（既定は INFO。DEBUG にすると列名の一覧などの詳細なログを出力）
+# format='%(levelname)s:%(message)s'でログのフォーマット指定
+logging.basicConfig(level=os.environ.get('POPMAP_LOG_LEVEL', 'INFO').upper(), format='%(levelname)s:%(message)s')
+
+# 他のファイルからlayoutとcallbacksをインポート
+from layout import layout
+from callbacks import register_callbacks
+from instrumentation import register_metrics_endpoint
+from serving import register_health_endpoints, preload_data, freeze_shared_memory, background_manager
+from spatial_index import register_spatial_endpoints
+from api import register_api
+import figure_cache
+
+def create_app(preload=False):
+    # Dashアプリを作成する（本番用のWSGIサーバーからは wsgi.py 経由で呼び出す）
+    # preload=True のときはデータセットと派生データを作成してから返す
+    # （POPMAP_FIGURE_CACHE_WARM を指定すると、地図・棒グラフの応答も作っておく）
+    # Dashアプリ全体を管理する土台を作成
+    # 時間のかかるデータの準備はバックグラウンドのジョブで行う（ジョブ管理を使えない環境ではリクエスト内で行う）
+    manager = background_manager()
+    dash_app = Dash(__name__, background_callback_manager=manager)
+
+    # アプリのレイアウトを設定
+    dash_app.layout = layout
+
+    # コールバック関数の登録
+    register_callbacks(dash_app, background=manager is not None)
+
+    # 処理時間・キャッシュ・エラー件数をPrometheus形式で返す /metrics を追加（計測は POPMAP_METRICS=1 のときのみ）
+    register_metrics_endpoint(dash_app.server)
+    # 死活監視用の /healthz と、データの準備ができているかを返す /readyz を追加
+    register_health_endpoints(dash_app.server)
+    # 緯度経度・範囲から町を引く /api/town-at と /api/towns-in-bbox を追加
+    register_spatial_endpoints(dash_app.server)
+    # 町ごとの統計を JSON・CSV・NDJSON で返すデータAPI（/api/cities 以下）を追加
+    register_api(dash_app.server)
+    # 同じ入力の地図・棒グラフのコールバックには、キャッシュしたシリアライズ済みの応答を返す
+    figure_cache.register_figure_cache(dash_app.server)
+
+    if preload:
+        cities = preload_data()
+        if figure_cache.WARM in ('maps', 'all'):
+            figure_cache.warm(dash_app.server, cities, towns=figure_cache.WARM == 'all')
+        freeze_shared_memory()
+    return dash_app
@@ -0,0 +1,158 @@
+# bands.py
+
+# 年齢層（バンド）の定義と集計
+# 「20-39歳」「65歳以上・女性」のような年齢層を (性別, 下限, 上限) として表し、
+# 町×5歳階級×性別の配列（age_profiles）と、5歳階級がその年齢層に含まれるかを表す行列の積で一度に集計する。
+# 集計結果はデータセットごとにメモ化し、使われた年齢層だけを計算する（読み込み時にすべての列を作成しない）
+
+import re
+
+import numpy as np  # 数値配列を扱うライブラリ
+from data_loader import get_city_data, get_derived, compact_columns, CATEGORY_COLUMNS
+from age_profiles import AGE_BINS, SEX_INDEX, age_profiles
+from derived_metrics import FEATURED_METRICS, parse_metric, metric_values, metric_label
+
+# 5歳階級の (下限, 上限)。上限が None の階級は「以上」
+BIN_RANGES = []
+for _label, _column in AGE_BINS:
+    _ages = [int(v) for v in re.findall(r'\d+', _label)]
+    BIN_RANGES.append((_ages[0], _ages[1] if len(_ages) > 1 else None))
+
+# 変数としてそのまま使える人口データの列（総数と5歳階級の人数）
+# シェイプファイルの属性列（面積・コードなど）やジオメトリは変数として扱わない
+COUNT_COLUMNS = frozenset(column for column in compact_columns() if column not in CATEGORY_COLUMNS)
+
+SEX_LABELS = {'total': '', 'male': '男性 ', 'female': '女性 '}
+
+# ドロップダウンに表示する変数の定義。ラベルと変数名はこの定義から生成する
+# 生徒候補（ラベルを個別に指定する年齢層）: (ラベル, 性別, 下限, 上限)
+FEATURED_BANDS = [
+    ("男女20-39歳", 'total', 20, 39),
+    ("男女小4-中3_10-14歳", 'total', 10, 14),
+    ("男20-39歳", 'male', 20, 39),
+    ("女20-39歳", 'female', 20, 39),
+    ("男小4-中3_10-14歳", 'male', 10, 14),
+    ("女小4-中3_10-14歳", 'female', 10, 14),
+]
+# 総人口関連（人口データの列をそのまま使う変数）
+TOTAL_VARIABLES = [
+    ("総人口", "population_total"),
+    ("男性", "male_total"),
+    ("女性", "female_total"),
+]
+# 年齢別・男性の年齢別・女性の年齢別に表示する年齢層: (下限, 上限)
+AGE_GROUP_BANDS = [(0, 9), (10, 19), (20, 29), (30, 39), (40, 49), (50, 59), (60, 69), (70, 74), (75, None)]
+
+def band_key(sex, lower, upper):
+    # 年齢層の変数名（例: age_20_39, male_age_under_10, female_age_over_75）
+    prefix = '' if sex == 'total' else f'{sex}_'
+    if upper is None:
+        return f'{prefix}age_over_{lower}'
+    if lower == 0:
+        return f'{prefix}age_under_{upper + 1}'
+    return f'{prefix}age_{lower}_{upper}'
+
+def band_label(sex, lower, upper):
+    if upper is None:
+        ages = f'{lower}歳以上'
+    elif lower == 0:
+        ages = f'{upper + 1}歳未満'
+    else:
+        ages = f'{lower}-{upper}歳'
+    return SEX_LABELS[sex] + ages
+
+def build_variable_options():
+    # ドロップダウンの選択肢 {ラベル: 変数名}（最後に人口密度・割合などの派生指標）
+    options = {}
+    for label, sex, lower, upper in FEATURED_BANDS:
+        options[label] = band_key(sex, lower, upper)
+    for label, column in TOTAL_VARIABLES:
+        options[label] = column
+    for sex in ('total', 'male', 'female'):
+        for lower, upper in AGE_GROUP_BANDS:
+            options[band_label(sex, lower, upper)] = band_key(sex, lower, upper)
+    for label, name in FEATURED_METRICS:
+        options[label] = name
+    return options
+
+_KEY_PATTERN = re.compile(r'^(?:(male|female)_)?age_(?:under_(\d+)|over_(\d+)|(\d+)_(\d+))$')
+_TEXT_PATTERN = re.compile(r'^\s*(\d+)\s*(?:(\+|以上)|[-～~]\s*(\d+))\s*(?:歳)?\s*(?:[,:、]\s*(total|male|female))?\s*$')
+
+def parse_band(spec):
+    # 変数名（age_20_39 など）または「65+」「0-14, female」形式の文字列を (性別, 下限, 上限) に変換する
+    # 年齢層として解釈できない場合は None を返す
+    match = _KEY_PATTERN.match(spec)
+    if match:
+        sex, under, over, lower, upper = match.groups()
+        sex = sex or 'total'
+        if under is not None:
+            return sex, 0, int(under) - 1
+        if over is not None:
+            return sex, int(over), None
+        return sex, int(lower), int(upper)
+    match = _TEXT_PATTERN.match(spec)
+    if match:
+        lower, open_ended, upper, sex = match.groups()
+        return sex or 'total', int(lower), None if open_ended else int(upper)
+    return None
+
+def band_membership(lower, upper):
+    # 5歳階級がこの年齢層に含まれるかを表す 0/1 のベクトル
+    # 年齢層の境界は5歳階級の境界と一致している必要がある
+    membership = np.zeros(len(BIN_RANGES), dtype=np.int32)
+    covered = []
+    for i, (bin_lower, bin_upper) in enumerate(BIN_RANGES):
+        inside_upper = upper is None or (bin_upper is not None and bin_upper <= upper)
+        if bin_lower >= lower and inside_upper:
+            membership[i] = 1
+            covered.append((bin_lower, bin_upper))
+    if not covered or covered[0][0] != lower or covered[-1][1] != upper:
+        raise ValueError(f"年齢層 {lower}-{upper if upper is not None else ''} は5歳階級の境界と一致しません。")
+    return membership
+
+def compute_bands(city, bands):
+    # 複数の年齢層を、(町, 5歳階級) の行列と (5歳階級, 年齢層) の所属行列の積でまとめて集計する
+    # bands は (性別, 下限, 上限) のリスト。戻り値は (町の数, 年齢層の数) の配列
+    matrix = age_profiles(city)['matrix']
+    result = np.empty((matrix.shape[0], len(bands)), dtype=np.int64)
+    for sex, index in SEX_INDEX.items():
+        columns = [i for i, band in enumerate(bands) if band[0] == sex]
+        if not columns:
+            continue
+        membership = np.column_stack([band_membership(bands[i][1], bands[i][2]) for i in columns])
+        result[:, columns] = matrix[:, :, index] @ membership
+    return result
+
+def band_values(city, spec):
+    # 年齢層の町ごとの人口。データセット・年齢層ごとにメモ化される
+    band = parse_band(spec)
+    if band is None:
+        raise KeyError(f"年齢層として解釈できません: {spec}")
+    return get_derived(city, ('band', band), lambda data: compute_bands(city, [band])[:, 0])
+
+def variable_values(city, variable):
+    # 地図の色分けなどに使う変数の町ごとの値（データの行順、float配列）
+    # 人口データの列があればその値を、派生指標（人口密度・割合など）ならその値を、
+    # どちらでもなければ年齢層として集計した値を返す（年齢層として解釈できない場合は KeyError）
+    data = get_city_data(city)
+    if variable in COUNT_COLUMNS and variable in data.columns:
+        return data[variable].to_numpy(dtype=float)
+    if parse_metric(variable) is not None:
+        return metric_values(city, variable)
+    values = band_values(city, variable).astype(float)
+    # 人口データと結合できなかった町は、列の場合と同じく欠損値にする
+    values[data['town_name'].isna().to_numpy()] = np.nan
+    return values
+
+def variable_label(variable, options=None):
+    # 変数の表示名。ドロップダウンの選択肢にない年齢層・派生指標はラベルを生成する
+    options = options or build_variable_options()
+    for label, value in options.items():
+        if value == variable:
+            return label
+    if parse_metric(variable) is not None:
+        return metric_label(variable, lambda base: variable_label(base, options))
+    band = parse_band(variable)
+    if band is not None:
+        return band_label(*band)
+    return variable
@@ -0,0 +1,329 @@
+# benchmark.py
+
+# データ読み込み・地図/棒グラフのコールバックの性能を計測するベンチマーク
+# コールバックはブラウザを使わず、app_factory.py で作成したアプリ（Flaskのテストクライアント）に直接リクエストを送って計測する。
+# 結果はJSONで出力するので、保存しておけば --compare で前回の結果と比較できる
+#
+# 使い方:
+#   python benchmark.py                          # 同梱データで計測し、結果をJSONで標準出力に表示
+#   python benchmark.py --output bench.json      # 結果をファイルに保存
+#   python benchmark.py --scales 4 16            # daitou を4倍・16倍に複製した合成データでも計測
+#   python benchmark.py --all-variables          # すべての変数について地図のコールバックを計測
+#   python benchmark.py --compare bench.json     # 前回の結果と比較した表を表示
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+import geopandas as gpd
+
+import data_loader
+import figure_cache
+from callback_requests import UPDATE_COMPONENT_PATH, DEPENDENCIES_PATH, find_callback, build_payload
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 既定で計測する市の組み合わせ（市区町村名のリスト）と変数
+DEFAULT_CITIES = [['higashiosaka'], ['daitou'], ['higashiosaka', 'daitou']]
+DEFAULT_VARIABLES = ['age_20_39', 'population_total', 'female_age_over_75']
+
+# 棒グラフのコールバックでクリックしたことにする町の数（市ごと）
+BAR_TOWNS_PER_CITY = 5
+
+def _quiet():
+    # 読み込み処理などが出力するメッセージで結果が読みにくくならないようにする
+    return contextlib.redirect_stdout(io.StringIO())
+
+def _stats(times):
+    times_ms = sorted(t * 1000 for t in times)
+    p95 = times_ms[min(len(times_ms) - 1, int(round(0.95 * (len(times_ms) - 1))))]
+    return {
+        'runs': len(times_ms),
+        'min_ms': round(times_ms[0], 3),
+        'median_ms': round(statistics.median(times_ms), 3),
+        'mean_ms': round(statistics.fmean(times_ms), 3),
+        'p95_ms': round(p95, 3),
+        'max_ms': round(times_ms[-1], 3),
+    }
+
+def _timed(fn, repeat, setup=None):
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+# ---- データ読み込み ----
+
+def bench_loader(components, repeat, scale=1):
+    city = data_loader.normalize_city(components)
+    results = []
+
+    def load_raw():
+        frames = [data_loader.load_municipality_data(name) for name in components]
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+    with _quiet():
+        times, _ = _timed(load_raw, repeat)
+        results.append(dict(benchmark='load.raw', city=city, scale=scale, **_stats(times)))
+
+        times, _ = _timed(lambda: data_loader.get_city_data(city), repeat, setup=data_loader.invalidate_cache)
+        results.append(dict(benchmark='load.cold', city=city, scale=scale, **_stats(times)))
+
+        times, _ = _timed(lambda: data_loader.get_city_data(city), max(repeat, 20))
+        results.append(dict(benchmark='load.warm', city=city, scale=scale, **_stats(times)))
+
+        # キャッシュが空の状態から読み込んだときのPythonのメモリ使用量のピーク
+        data_loader.invalidate_cache()
+        tracemalloc.start()
+        data = data_loader.get_city_data(city)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    results.append(dict(benchmark='memory.cold_load', city=city, scale=scale, peak_bytes=peak,
+                        dataset_bytes=int(data.memory_usage(deep=True).sum()), rows=len(data)))
+    return results
+
+# ---- コールバック ----
+
+def _post(client, payload):
+    start = time.perf_counter()
+    response = client.post(UPDATE_COMPONENT_PATH, json=payload)
+    elapsed = time.perf_counter() - start
+    if response.status_code not in (200, 204):
+        raise RuntimeError(f"{payload['output']}: HTTP {response.status_code}")
+    return elapsed, response.get_data()
+
+def bench_callbacks(client, dependencies, components, variables, repeat, scale=1):
+    city = data_loader.normalize_city(components)
+    map_spec = find_callback(dependencies, 'mapPlot.figure')
+    bar_spec = find_callback(dependencies, 'barPlot.figure')
+    results = []
+
+    with _quiet():
+        for variable in variables:
+            values = {'city_selection.value': components, 'data_ready.data': {'city': city}, 'variable.value': variable}
+            full = build_payload(map_spec, values, ['data_ready.data'])
+
+            # キャッシュが空の状態で市を選んだとき（読み込みを含む）
+            data_loader.invalidate_cache()
+            elapsed, body = _post(client, full)
+            results.append(dict(benchmark='map.full.cold', city=city, variable=variable, scale=scale,
+                                bytes=len(body), **_stats([elapsed])))
+
+            # 市を選んだとき（ジオメトリを含む地図全体）
+            times, sizes = [], []
+            for _ in range(repeat):
+                elapsed, body = _post(client, full)
+                times.append(elapsed)
+                sizes.append(len(body))
+            results.append(dict(benchmark='map.full', city=city, variable=variable, scale=scale,
+                                bytes=max(sizes), **_stats(times)))
+
+            # 同じ市のまま変数だけを切り替えたとき（値だけの部分更新）
+            patch = build_payload(map_spec, dict(values, **{'map_state.data': {'city': city}}), ['variable.value'])
+            times, sizes = [], []
+            for _ in range(repeat):
+                elapsed, body = _post(client, patch)
+                times.append(elapsed)
+                sizes.append(len(body))
+            results.append(dict(benchmark='map.patch', city=city, variable=variable, scale=scale,
+                                bytes=max(sizes), **_stats(times)))
+
+        # 地図上の町をクリックしたとき
+        data = data_loader.get_city_data(city)
+        towns = data['town_name'].dropna().drop_duplicates()
+        towns = towns.iloc[::max(1, len(towns) // BAR_TOWNS_PER_CITY)].head(BAR_TOWNS_PER_CITY).tolist()
+        times, sizes = [], []
+        for _ in range(repeat):
+            for town in towns:
+                values = {'city_selection.value': components, 'data_ready.data': {'city': city},
+                          'mapPlot.clickData': {'points': [{'location': town}]}}
+                elapsed, body = _post(client, build_payload(bar_spec, values, ['mapPlot.clickData']))
+                times.append(elapsed)
+                sizes.append(len(body))
+        results.append(dict(benchmark='bar.click', city=city, scale=scale, bytes=max(sizes), **_stats(times)))
+
+        # ボックス・投げ縄で町をまとめて選択したとき（データセットのすべての町を選択）
+        selected = {'points': [{'location': town} for town in data['town_name'].dropna().tolist()]}
+        values = {'city_selection.value': components, 'data_ready.data': {'city': city}, 'mapPlot.selectedData': selected}
+        payload = build_payload(bar_spec, values, ['mapPlot.selectedData'])
+        times, sizes = [], []
+        for _ in range(repeat):
+            elapsed, body = _post(client, payload)
+            times.append(elapsed)
+            sizes.append(len(body))
+        results.append(dict(benchmark='bar.select', city=city, scale=scale, towns=len(selected['points']),
+                            bytes=max(sizes), **_stats(times)))
+    return results
+
+def bench_response_cache(client, dependencies, components, variables, repeat):
+    # 応答キャッシュ（figure_cache.py）に入っている地図を返すとき（コールバックを呼ばない）
+    city = data_loader.normalize_city(components)
+    map_spec = find_callback(dependencies, 'mapPlot.figure')
+    results = []
+    figure_cache.ENABLED = True
+    try:
+        with _quiet():
+            for variable in variables:
+                values = {'city_selection.value': components, 'data_ready.data': {'city': city}, 'variable.value': variable}
+                full = build_payload(map_spec, values, ['data_ready.data'])
+                _post(client, full)
+                times, sizes = [], []
+                for _ in range(repeat):
+                    elapsed, body = _post(client, full)
+                    times.append(elapsed)
+                    sizes.append(len(body))
+                results.append(dict(benchmark='map.full.cached', city=city, variable=variable,
+                                    bytes=max(sizes), **_stats(times)))
+    finally:
+        figure_cache.ENABLED = False
+        figure_cache.clear()
+    return results
+
+# ---- 合成データ ----
+
+def make_synthetic_dataset(source, copies, data_dir):
+    # source の市区町村を copies 個ならべて複製した市区町村 synthetic_<source>_x<copies> を data_dir に作成する
+    # 町名には複製番号を付け、ジオメトリは東方向にずらして重ならないようにする
+    name = f"synthetic_{source}_x{copies}"
+    source_dir = os.path.join(BASE_DIR, 'data', source)
+    target_dir = os.path.join(data_dir, name)
+    os.makedirs(target_dir, exist_ok=True)
+
+    population = pd.read_csv(os.path.join(source_dir, f"{source}_population.csv"), encoding='utf-8')
+    shapes = gpd.read_file(os.path.join(source_dir, f"{source}.shp"), encoding='utf-8')
+    merge_column = next(col for col in shapes.columns if col.lower() == 's_name')
+    minx, _, maxx, _ = shapes.total_bounds
+    width = maxx - minx
+
+    population_copies, shape_copies = [], []
+    for i in range(copies):
+        population_copy = population.copy()
+        population_copy['NAME'] = population_copy['NAME'].astype(str) + f"_{i}"
+        population_copies.append(population_copy)
+        shape_copy = shapes.copy()
+        shape_copy[merge_column] = shape_copy[merge_column].astype(str) + f"_{i}"
+        shape_copy['geometry'] = shape_copy.geometry.translate(xoff=i * width * 1.05)
+        shape_copies.append(shape_copy)
+
+    pd.concat(population_copies, ignore_index=True).to_csv(
+        os.path.join(target_dir, f"{name}_population.csv"), index=False, encoding='utf-8')
+    gpd.GeoDataFrame(pd.concat(shape_copies, ignore_index=True), crs=shapes.crs).to_file(
+        os.path.join(target_dir, f"{name}.shp"), encoding='utf-8')
+    return name
+
+# ---- 実行・比較 ----
+
+def _metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import dash, plotly, shapely
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': {'pandas': pd.__version__, 'geopandas': gpd.__version__, 'shapely': shapely.__version__,
+                     'plotly': plotly.__version__, 'dash': dash.__version__},
+    }
+
+def _result_key(result):
+    return (result['benchmark'], result.get('city'), result.get('variable'), result.get('scale', 1))
+
+def compare(previous, current):
+    # 同じ計測項目の中央値（ms）とバイト数を前回と比べた表を表示する
+    old = {_result_key(r): r for r in previous['results']}
+    print(f"{'benchmark':<18} {'city':<28} {'variable':<20} {'scale':>5} {'old_ms':>10} {'new_ms':>10} {'ratio':>7} {'bytes':>10}")
+    for result in current['results']:
+        before = old.get(_result_key(result))
+        if before is None or 'median_ms' not in result:
+            continue
+        ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('nan')
+        print(f"{result['benchmark']:<18} {result['city']:<28} {result.get('variable') or '':<20} "
+              f"{result.get('scale', 1):>5} {before['median_ms']:>10.2f} {result['median_ms']:>10.2f} "
+              f"{ratio:>7.2f} {result.get('bytes', ''):>10}")
+
+def run(cities, variables, repeat, scales):
+    from app_factory import create_app
+    app = create_app()  # app.py の開発用サーバーと同じ構成のアプリ（コールバック登録済み）
+    logging.getLogger().setLevel(logging.WARNING)
+    client = app.server.test_client()
+    dependencies = client.get(DEPENDENCIES_PATH).get_json()
+    # コールバックそのものの処理時間を計測するため、応答キャッシュは map.full.cached 以外では使わない
+    figure_cache.ENABLED = False
+
+    results = []
+    for components in cities:
+        results.extend(bench_loader(components, repeat))
+        results.extend(bench_callbacks(client, dependencies, components, variables, repeat))
+        results.extend(bench_response_cache(client, dependencies, components, variables, repeat))
+
+    if scales:
+        # 合成データは一時ディレクトリに作成し、データの読み込み先をそこに切り替えて計測する
+        original_data_dir = data_loader.DATA_DIR
+        with tempfile.TemporaryDirectory(prefix='popmap-bench-') as tmp:
+            try:
+                data_loader.DATA_DIR = tmp
+                for scale in scales:
+                    with _quiet():
+                        name = make_synthetic_dataset('daitou', scale, tmp)
+                    results.extend(bench_loader([name], repeat, scale=scale))
+                    results.extend(bench_callbacks(client, dependencies, [name], variables[:1], repeat, scale=scale))
+            finally:
+                data_loader.DATA_DIR = original_data_dir
+                data_loader.invalidate_cache()
+    return {'meta': _metadata(), 'results': results}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="データ読み込みとコールバックの性能を計測する")
+    parser.add_argument('--city', action='append', dest='cities',
+                        help="計測する市（'+' 区切りで組み合わせ。複数指定可）。省略時は東大阪市・大東市・両市")
+    parser.add_argument('--variable', action='append', dest='variables', help="計測する変数（複数指定可）")
+    parser.add_argument('--all-variables', action='store_true', help="ドロップダウンのすべての変数を計測する")
+    parser.add_argument('--repeat', type=int, default=5, help="各項目の繰り返し回数")
+    parser.add_argument('--scales', type=int, nargs='*', default=[], help="合成データの複製数（例: 4 16 64）")
+    parser.add_argument('--output', help="結果のJSONを書き出すファイル（省略時は標準出力）")
+    parser.add_argument('--compare', help="比較する前回の結果のJSONファイル")
+    args = parser.parse_args(argv)
+
+    cities = [city.split('+') for city in args.cities] if args.cities else DEFAULT_CITIES
+    if args.all_variables:
+        from layout import variable_options
+        variables = list(variable_options.values())
+    else:
+        variables = args.variables or DEFAULT_VARIABLES
+
+    report = run(cities, variables, args.repeat, args.scales)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+    elif not args.output:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
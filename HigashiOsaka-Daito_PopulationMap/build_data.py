@@ -0,0 +1,37 @@
+# build_data.py
+
+# 市区町村データの「コンパイル」コマンド
+# CSVとシェイプファイルを読み込み、集計・マージ・EPSG:4326への変換を済ませた結果を
+# data/<市区町村>/<市区町村>.parquet に書き出す。data_loader は最新のファイルがあればそれを読み込む
+#
+# 使い方:
+#   python build_data.py                 # data/ 以下のすべての市区町村をビルド
+#   python build_data.py daitou --force  # 指定した市区町村を強制的に再ビルド
+
+import argparse
+import logging
+import sys
+
+from data_loader import compile_municipality_data, discover_municipalities
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="市区町村データをコンパイル済み形式（GeoParquet）に変換する")
+    parser.add_argument('municipalities', nargs='*', help="対象の市区町村名（省略時は data/ 以下のすべて）")
+    parser.add_argument('--force', action='store_true', help="最新でも再ビルドする")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
+
+    names = args.municipalities or list(discover_municipalities())
+    failed = False
+    for name in names:
+        try:
+            built = compile_municipality_data(name, force=args.force)
+            print(f"{name}: {'built' if built else 'up to date'}")
+        except Exception as e:
+            logging.error(f"{name} のビルド中にエラーが発生しました: {e}")
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,46 @@
+# callback_requests.py
+
+# Dashのコールバックをブラウザを使わずに呼び出すためのリクエスト作成処理
+# /_dash-dependencies で取得できるコールバックの定義から /_dash-update-component に送る本文を組み立てる。
+# benchmark.py（Flaskのテストクライアント経由）と loadtest.py（HTTP経由）で共通に使う
+
+UPDATE_COMPONENT_PATH = '/_dash-update-component'
+DEPENDENCIES_PATH = '/_dash-dependencies'
+
+def _split_output(output):
+    # 'mapPlot.figure' や '..mapPlot.figure...map_state.data..'（複数出力）を [{'id', 'property'}, ...] に分解する
+    if output.startswith('..') and output.endswith('..'):
+        parts = output[2:-2].split('...')
+    else:
+        parts = [output]
+    return [dict(zip(('id', 'property'), part.rsplit('.', 1))) for part in parts]
+
+def find_callback(dependencies, output):
+    # 出力（例: 'mapPlot.figure'）を含むコールバックの定義を探す
+    for spec in dependencies:
+        if any(f"{o['id']}.{o['property']}" == output for o in _split_output(spec['output'])):
+            return spec
+    raise KeyError(f"コールバックが見つかりません: {output}")
+
+def build_payload(spec, values, changed):
+    # values: {'city_selection.value': [...], 'variable.value': 'age_20_39', ...}
+    # changed: 変更された入力（例: ['variable.value']）。コールバック内の ctx.triggered_id に使われる
+    outputs = _split_output(spec['output'])
+    def props(items):
+        return [{'id': item['id'], 'property': item['property'],
+                 'value': values.get(f"{item['id']}.{item['property']}")} for item in items]
+    return {
+        'output': spec['output'],
+        'outputs': outputs if len(outputs) > 1 else outputs[0],
+        'inputs': props(spec['inputs']),
+        'state': props(spec.get('state', [])),
+        'changedPropIds': list(changed),
+    }
+
+def response_outputs(body):
+    # /_dash-update-component の応答本文（JSON）から {'mapPlot.figure': ..., ...} を取り出す
+    outputs = {}
+    for component_id, props in body.get('response', {}).items():
+        for prop, value in props.items():
+            outputs[f"{component_id}.{prop}"] = value
+    return outputs
@@ -1,209 +1,280 @@
 # callbacks.py
 
-import pandas as pd  # データ操作ライブラリ。データフレーム形式でのデータ処理や分析に使用
-import plotly.express as px  # 簡易でインタラクティブなグラフ作成ツール
+import uuid  # バックグラウンドのジョブをリクエストごとに区別するID
 import plotly.graph_objects as go  # 高度にカスタマイズ可能なグラフ作成用ツール
-from dash.dependencies import Output, Input  # Dashコールバックで出力（Output）と入力（Input）を定義するためのモジュール
+from dash import ctx, no_update  # コールバックのきっかけとなった入力の判定と、出力を更新しない場合の値
+from dash.dependencies import Output, Input, State  # Dashコールバックで出力（Output）と入力（Input）、状態（State）を定義するためのモジュール
 from layout import variable_options  # 別ファイルから変数オプション（ドロップダウン選択肢など）をインポート
-from data_loader import load_municipality_data  # 別ファイルから市区町村データを読み込む関数をインポート
+from data_loader import get_city_data, resolve_city  # 別ファイルから市区町村データを（キャッシュ経由で）取得する関数と、選択された市区町村名を検証する関数をインポート
+from data_loader import city_components, city_display_name, city_data_ready, ensure_compiled_data  # データの準備状態の確認とコンパイル済みデータの作成
+from figures import build_map_figure, map_value_patch, build_bar_figure  # 地図・棒グラフのFigure作成、地図の部分更新を行う関数をインポート
+from bands import variable_label  # 変数の表示名を取得する関数をインポート
+from age_profiles import town_profile, aggregate_profile  # 町ごとの年齢構成を取り出す関数と、複数の町の合計を求める関数をインポート
+from time_series import year_choices  # 年のスライダーの選択肢（年次の人口データ）
+from instrumentation import span, increment  # 処理時間の計測とエラー件数のカウンタ
+import figure_cache  # 地図・棒グラフの応答のキャッシュ
 import logging  # ログを出力するためのモジュール。デバッグや問題のトラッキングに役立つ
 
-def register_callbacks(app): # Dashアプリケーションにコールバックを登録する関数
+# 年のスライダーを表示するときのスタイル
+YEAR_CONTROL_STYLE = {'display': 'flex', 'alignItems': 'center', 'padding': '5px 10px'}
+# データの準備中の表示のスタイル
+LOAD_STATUS_STYLE = {'display': 'flex', 'alignItems': 'center', 'padding': '5px 10px'}
+
+def _selected_year(city, index):
+    # 年のスライダーの値（選択肢の番号）を年に変換する（「最新」や範囲外の場合は None）
+    choices = year_choices(city)
+    if index is None or not 0 <= index < len(choices):
+        return None
+    return choices[index][0]
+
+def _ready_city(data_ready, city_value):
+    # 選択中の市のデータの準備ができていればその市の名前を、まだ（バックグラウンドで準備中）なら None を返す
+    # （data/ 以下にない市区町村名を含む場合も None）
+    city = resolve_city(city_value)
+    if city and (data_ready or {}).get('city') == city:
+        return city
+    return None
+
+def _is_value_update(changed, city, map_state):
+    # 変数や年だけが切り替わり、同じ市のジオメトリがすでに地図に読み込まれているか（値だけを部分更新できるか）
+    return ('data_ready.data' not in changed and any(p in changed for p in ('variable.value', 'year.value'))
+            and bool(map_state) and map_state.get('city') == city)
+
+def _bar_target(clickData, selectedData, changed):
+    # 棒グラフに表示するもの: ('selection', 町名のリスト)・('town', 町名)・None（表示するものがない）
+    # ボックス・投げ縄で選択された町があればその合計（町をクリックしたときは、選択よりクリックした町を優先する）
+    selected_towns = [point['location'] for point in (selectedData or {}).get('points', []) if 'location' in point]
+    if selected_towns and 'mapPlot.clickData' not in changed:
+        return 'selection', selected_towns
+    points = (clickData or {}).get('points') or []
+    if points and 'location' in points[0]:
+        return 'town', points[0]['location']
+    return None
+
+def _map_cache_key(values, changed):
+    # 地図の応答は 市・変数・年・部分更新かどうか で決まる（データの準備中の応答はキャッシュしない）
+    city = _ready_city(values.get('data_ready.data'), values.get('city_selection.value'))
+    variable = values.get('variable.value')
+    if not city or not variable:
+        return None
+    mode = 'patch' if _is_value_update(changed, city, values.get('map_state.data')) else 'full'
+    return city, ('map', variable, values.get('year.value'), mode)
+
+def _bar_cache_key(values, changed):
+    # 棒グラフの応答は 市・クリックした町（または選択した町の集合）で決まる
+    city = _ready_city(values.get('data_ready.data'), values.get('city_selection.value'))
+    target = _bar_target(values.get('mapPlot.clickData'), values.get('mapPlot.selectedData'), changed)
+    if not city or target is None:
+        return None
+    kind, towns = target
+    return city, ('bar', kind, tuple(sorted(set(towns))) if kind == 'selection' else towns)
+
+def register_callbacks(app, background=False): # Dashアプリケーションにコールバックを登録する関数
+    # background=True のときは、時間のかかるデータの準備をバックグラウンドコールバック（アプリのジョブ管理）で行う
+    @app.callback(
+        [Output('data_ready', 'data'), Output('load_request', 'data')],
+        Input('city_selection', 'value')
+    )
+    def check_data(city): # 選択された市のデータをすぐに用意できるかを確認する関数
+        # クライアントから送られた値はそのままファイルのパスに使わず、data/ 以下にある市区町村かを確認する
+        city = resolve_city(city)
+        if not city:
+            return None, no_update
+        # 読み込み済み・コンパイル済みのデータがあれば、地図・棒グラフのコールバックの中で読み込む（ジョブ管理がない場合も同様）
+        if not background or city_data_ready(city):
+            return {'city': city}, no_update
+        # 元ファイルの読み込み・マージ・座標変換が必要な場合はバックグラウンドで準備する
+        # （同じ市を複数の利用者が同時に選んだ場合も、ジョブの結果が混ざらないようにリクエストごとにIDを付ける）
+        logging.info("Preparing data for %s in the background.", city)
+        return no_update, {'city': city, 'request': uuid.uuid4().hex}
+
+    if background:
+        @app.callback(
+            Output('data_ready', 'data', allow_duplicate=True),
+            Input('load_request', 'data'),
+            background=True,
+            progress=[Output('load_progress', 'value'), Output('load_progress', 'max'), Output('load_message', 'children')],
+            running=[(Output('load_status', 'style'), LOAD_STATUS_STYLE, {'display': 'none'})],
+            # 準備中に別の市が選ばれたらジョブを止める（古いジョブが後から data_ready を前の市に書き換えないように）
+            cancel=[Input('city_selection', 'value')],
+            prevent_initial_call=True
+        )
+        def prepare_data(set_progress, load_request): # 市を構成する市区町村のコンパイル済みデータを作成する関数（別プロセスで実行）
+            # 確認済みの名前だけを使う（load_request はクライアントから送り直すことができる）
+            city = resolve_city((load_request or {}).get('city'))
+            if city is None:
+                return no_update
+            components = city_components(city)
+            for i, name in enumerate(components):
+                set_progress((str(i), str(len(components)), f'{city_display_name(name)}のデータを準備しています…'))
+                try:
+                    # 同じ市区町村を準備中のジョブ・プロセスがあれば、その作成が終わるのを待つ（作成は1回だけ）
+                    ensure_compiled_data(name)
+                except Exception:
+                    # 準備できなかった場合も、地図のコールバックでの読み込み（とそのエラー処理）に任せる
+                    logging.exception("%s のデータの準備中にエラーが発生しました。", name)
+            set_progress((str(len(components)), str(len(components)), 'データを読み込んでいます…'))
+            return {'city': city}
+
+    @app.callback(
+        [Output('year', 'marks'), Output('year', 'max'), Output('year', 'value'), Output('year_control', 'style')],
+        Input('city_selection', 'value')
+    )
+    def update_year_control(city): # 選択された市の年次データの年をスライダーに設定する関数
+        city = resolve_city(city)
+        choices = year_choices(city) if city else []
+        marks = {i: label for i, (_, label) in enumerate(choices)} or {0: '最新'}
+        # 年次データがない（選択肢が「最新」だけの）場合はスライダーを表示しない
+        style = YEAR_CONTROL_STYLE if len(choices) > 1 else {'display': 'none'}
+        # 市を切り替えたときは最新のデータを表示する
+        return marks, len(marks) - 1, len(marks) - 1, style
+
+    @app.callback(
+        [Output('year_timer', 'disabled'), Output('year_play', 'children')],
+        [Input('year_play', 'n_clicks'), Input('city_selection', 'value')],
+        State('year_timer', 'disabled')
+    )
+    def toggle_year_play(n_clicks, city, disabled): # 再生ボタンで年の自動送りを開始・停止する関数
+        # 市を切り替えたときは止める（年次データのない市ではスライダーと再生ボタンが表示されず、止められなくなるため）
+        if not n_clicks or ctx.triggered_id == 'city_selection':
+            return True, '▶ 再生'
+        return (False, '■ 停止') if disabled else (True, '▶ 再生')
+
+    @app.callback(
+        Output('year', 'value', allow_duplicate=True),
+        Input('year_timer', 'n_intervals'),
+        [State('year', 'value'), State('year', 'max')],
+        prevent_initial_call=True
+    )
+    def advance_year(n_intervals, index, max_index): # 一定間隔ごとに次の年へ進める（最後まで進んだら最初に戻る）
+        return 0 if index is None or index >= max_index else index + 1
+
     @app.callback( # @で関数に機能を追加(Dashの場合この関数の監視の役割)
-        Output('mapPlot', 'figure'), # 出力対象。ここではIDが 'mapPlot' のグラフに更新されたFigureを渡す
-        [Input('city_selection', 'value'), Input('variable', 'value')] # 入力対象。'city_selection' と 'variable' の値を監視
+        [Output('mapPlot', 'figure'), # 出力対象。ここではIDが 'mapPlot' のグラフに更新されたFigureを渡す
+         Output('map_state', 'data')], # 地図に現在どの市のジオメトリが読み込まれているかを記録する
+        [Input('data_ready', 'data'), Input('variable', 'value'), Input('year', 'value')], # 入力対象。データの準備ができた市・'variable'・年のスライダー 'year' の値を監視
+        [State('city_selection', 'value'), State('map_state', 'data')]
     )
-    def update_map(city, selected_var): # 選択したcityと変数selected_varに基づいて地図を更新する関数
-        logging.debug(f"update_map callback triggered with city: {city}, selected_var: {selected_var}") # ログにcityとselected_varの値を記録
-        print(f"update_map callback triggered with city: {city}, selected_var: {selected_var}") # コンソールにcityとselected_varの値を出力
+    def update_map(data_ready, selected_var, year_index, city, map_state): # 選択したcityと変数selected_var、年に基づいて地図を更新する関数
+        city = resolve_city(city) # 複数選択された市区町村を組み合わせビューの名前に変換（data/ 以下にない市区町村名を含む場合は None）
+        logging.debug("update_map callback triggered with city: %s, selected_var: %s", city, selected_var) # ログにcityとselected_varの値を記録
         
         if not city or not selected_var: # ユーザーが市区町村（city）または変数（selected_var）を選択していない場合の処理
             logging.info("City or variable not selected. Returning empty figure.") # ログに「市区町村または変数が未選択」と記録
-            print("City or variable not selected. Returning empty figure.") # コンソールにも同じメッセージを出力
-            return go.Figure() # 空白の地図を表示する（何も描画されていない状態）
+            return go.Figure(), None # 空白の地図を表示する（何も描画されていない状態）
+
+        if _ready_city(data_ready, city) is None: # データをバックグラウンドで準備中の場合は、準備ができてから（data_ready の更新で）描画する
+            logging.debug("Data for %s is not ready yet.", city)
+            return no_update, no_update
 
         try:
-            # 東大阪市＆大東市
-            
-            if city == 'higashiosaka_daitou': # 東大阪市＆大東市を選択された場合
-                data1 = load_municipality_data('higashiosaka')
-                data2 = load_municipality_data('daitou')
-                data = pd.concat([data1, data2], ignore_index=True) # 両市のデータを結合
-            else:
-                data = load_municipality_data(city) # 他の市の場合、その市のデータのみを読み込む
+            display_label = variable_label(selected_var, variable_options) # 選択された変数（selected_var）に対応するラベル（key）を取得（選択肢にない年齢層はラベルを生成）
+            # 年次データの年が選ばれている場合はその年の値を表示し、ラベルに年を付ける
+            year = _selected_year(city, year_index)
+            if year is not None:
+                display_label = f"{display_label}（{year}年）"
 
-            display_label = [k for k, v in variable_options.items() if v == selected_var][0] # 選択された変数（selected_var）に対応するラベル（key）を取得
+            # 変数や年だけが切り替わり、同じ市のジオメトリがすでに地図に読み込まれている場合は
+            # ジオメトリを送り直さず、色分けの値・範囲・ホバー表示だけを更新する
+            if _is_value_update(list(ctx.triggered_prop_ids), city, map_state):
+                logging.debug("Patching map values with selected_var: %s, year: %s", selected_var, year)
+                with span('map_patch_build'):
+                    patch = map_value_patch(city, selected_var, display_label, year)
+                return patch, no_update
+
+            # 東大阪市＆大東市のような組み合わせビューも含め、結合済みのデータをキャッシュから取得
+            data = get_city_data(city)
 
             if 'town_name' not in data.columns: # 'town_name' がデータに含まれていない場合、空白の地図を表示する（何も描画されていない状態）
                 logging.error("Column 'town_name' not found in data.")
-                print("Column 'town_name' not found in data.")
-                return go.Figure()
+                figure_cache.skip()
+                return go.Figure(), None
 
             if data.geometry.isnull().all(): # 全て欠損値かどうかを確認。もしそうなら、空白の地図を表示する（何も描画されていない状態）
                 logging.error("Geometry data is missing.")
-                print("Geometry data is missing.")
-                return go.Figure()
-
-            if data.crs != "EPSG:4326": # データの座標参照系が EPSG:4326 でない場合変換。Dashで地図を描画する際に使用する必要がある
-                data = data.to_crs(epsg=4326)
-                logging.info("Coordinate reference system transformed to EPSG:4326.")
-                print("Coordinate reference system transformed to EPSG:4326.")
+                figure_cache.skip()
+                return go.Figure(), None
 
-            logging.debug(f"Generating map with selected_var: {selected_var}")
-            print(f"Generating map with selected_var: {selected_var}")
+            logging.debug("Generating map with selected_var: %s", selected_var)
             
-            fig = px.choropleth_mapbox(
-                data, # 入力データ
-                geojson=data.__geo_interface__, # GeoJSON形式でのジオメトリ情報指定
-                locations='town_name', # データフレームの列から地図の位置（町名）を指定
-                color=selected_var, # 色付けに使う変数（ドロップダウンで選択された変数に基づく）
-                featureidkey='properties.town_name', # GeoJSON内の町名プロパティとデータを対応付けるキー
-                mapbox_style="open-street-map", # 地図のスタイル（オープンストリートマップ）
-                center={"lat": data.geometry.centroid.y.mean(), "lon": data.geometry.centroid.x.mean()},# 地図の初期表示の中心座標を設定
-                opacity=0.5, # 地図上の色付けの透明度を指定  
-                labels={selected_var: display_label}
-            )
-            # 選んだ市の地図の表示の仕方
-            if city == 'higashiosaka_daitou':
-                fig.update_layout(
-                    mapbox=dict(
-                        zoom=11.9,
-                        center={
-                            "lat": data.geometry.centroid.y.mean() + 0.004,  # 地図縦軸調整
-                            "lon": data.geometry.centroid.x.mean() + 0.006   # 地図横軸調整
-                        }
-                    )
-                )
-            if city == 'higashiosaka':
-                fig.update_layout(
-                    mapbox=dict(
-                        zoom=12.4,
-                        center={
-                            "lat": data.geometry.centroid.y.mean() - 0.002,
-                            "lon": data.geometry.centroid.x.mean() + 0.015
-                        }
-                    )
-                )
-            if city == 'daitou':
-                fig.update_layout(
-                    mapbox=dict(
-                        zoom=13.1,
-                        center={
-                            "lat": data.geometry.centroid.y.mean() + 0.001,
-                            "lon": data.geometry.centroid.x.mean() + 0.006
-                        }
-                    )
-                )
-            # 地図のホバーテキストのフォーマットを設定
-            # %{location} は町名、%{z} は選択された変数の値（色分けに使用される変数）を表示
-            # <extra></extra> は追加の情報を表示しないために空の部分を指定
-            fig.update_traces(hovertemplate="<b>%{location}</b><br>" + display_label + ": %{z}<extra></extra>")
-            # グラフが領域いっぱいに表示されるように右（r）、上（t）、左（l）、下（b）の余白をすべて0に設定
-            fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
+            # ジオメトリを含む地図全体を作成（座標系はキャッシュ時にEPSG:4326へ変換済み）
+            with span('map_figure_build'):
+                fig = build_map_figure(city, selected_var, display_label, year)
             logging.info("Map updated successfully.")
-            print("Map updated successfully.")
-            # 更新した地図（fig）を返す
-            return fig
+            # 更新した地図（fig）と、読み込んだ市を返す
+            return fig, {'city': city}
         except FileNotFoundError as e:
             logging.error(e)
-            print(e)
-            return go.Figure()
+            increment('callback_errors_total', callback='update_map', error='FileNotFoundError')
+            figure_cache.skip()
+            return go.Figure(), None
         except Exception as e:
             logging.exception("予期しないエラーが発生しました。")
-            print("予期しないエラーが発生しました。")
-            return go.Figure()
+            increment('callback_errors_total', callback='update_map', error=type(e).__name__)
+            figure_cache.skip()
+            return go.Figure(), None
 
     @app.callback(
         # 'barPlot'の'figure'を更新するための出力定義
         Output('barPlot', 'figure'),
-        # 入力：'mapPlot'の'clickData'と'city_selection'の'value'を監視
-        [Input('mapPlot', 'clickData'), Input('city_selection', 'value')]
+        # 入力：'mapPlot'の'clickData'とデータの準備ができた市、ボックス・投げ縄選択の'selectedData'を監視
+        [Input('mapPlot', 'clickData'), Input('data_ready', 'data'), Input('mapPlot', 'selectedData')],
+        State('city_selection', 'value')
     )
-    def update_bar(clickData, city):
+    def update_bar(clickData, data_ready, selectedData, city):
+        city = resolve_city(city) # 複数選択された市区町村を組み合わせビューの名前に変換（data/ 以下にない市区町村名を含む場合は None）
+        if city and _ready_city(data_ready, city) is None: # データを準備中の場合は、準備ができてから更新する
+            return no_update
         # コールバックがトリガーされたときにデバッグ用のログとメッセージを出力
         logging.debug("update_bar callback triggered.")
-        print("update_bar callback triggered.")
+        # ボックス・投げ縄で選択された町、またはクリックされた町
+        target = _bar_target(clickData, selectedData, list(ctx.triggered_prop_ids))
         # clickDataやcityが空の場合、空のグラフを返す
-        if not clickData or not city:
+        if not city or target is None:
             logging.info("Insufficient data for bar plot. Returning empty figure.")
-            print("Insufficient data for bar plot. Returning empty figure.")
             return go.Figure()
 
         try:
+            if target[0] == 'selection':
+                selected_towns = target[1]
+                # 選択したすべての町の年齢構成を、町×年齢階級×性別の配列からまとめて合計する
+                with span('bar_aggregate'):
+                    profile, count = aggregate_profile(city, selected_towns)
+                logging.info("Selected towns: %d (matched: %d)", len(selected_towns), count)
+                if profile is None:
+                    logging.warning("No data found for the selected towns.")
+                    return go.Figure()
+                with span('bar_figure_build'):
+                    fig = build_bar_figure(f'選択した{count}町', profile)
+                return fig
+
             # 地図上でクリックされた地点の町名を取得
-            town_name = clickData['points'][0]['location']
-            logging.info(f"Clicked town: {town_name}")
-            print(f"Clicked town: {town_name}")
+            town_name = target[1]
+            logging.info("Clicked town: %s", town_name)
             
-            # 東大阪市＆大東市が選択された場合、両市のデータを結合して取得
-            if city == 'higashiosaka_daitou':
-                data1 = load_municipality_data('higashiosaka')
-                data2 = load_municipality_data('daitou')
-                data = pd.concat([data1, data2], ignore_index=True)
-            else:
-                # その他の市の場合、その市のデータを取得
-                data = load_municipality_data(city)
-
-            # クリックされた町名に一致するデータを抽出
-            selected_town_data = data[data['town_name'] == town_name]
-            logging.info(f"Updating bar plot for town: {town_name}")
-            print(f"Updating bar plot for town: {town_name}")
+            # 町名の索引から、選択された市（東大阪市＆大東市の場合は両市を結合したもの）の年齢構成を1行取り出す
+            profile = town_profile(city, town_name)
+            logging.info("Updating bar plot for town: %s", town_name)
    
             # 該当する町のデータが見つからない場合、空のグラフを返す
-            if selected_town_data.empty:
+            if profile is None:
                 logging.warning(f"No data found for town: {town_name}")
-                print(f"No data found for town: {town_name}")
                 return go.Figure()
 
-            # 年齢区分の列名と対応するラベルをリストで定義
-            age_groups = [
-                'age_0_4', 'age_5_9', 'age_10_14', 'age_15_19',
-                'age_20_24', 'age_25_29', 'age_30_34', 'age_35_39',
-                'age_40_44', 'age_45_49', 'age_50_54', 'age_55_59',
-                'age_60_64', 'age_65_69', 'age_70_74'#, 'age_over_75'
-            ]
-            age_labels = [
-                '0-4', '5-9', '10-14', '15-19',
-                '20-24', '25-29', '30-34', '35-39',
-                '40-44', '45-49', '50-54', '55-59',
-                '60-64', '65-69', '70-74'#, '75以上'
-            ]
-
-            # 各年齢区分の人口を取得し、リストに追加
-            population_values = []
-            actual_age_labels = [] # 実際に使用される年齢ラベルを格納
-            for ag, label in zip(age_groups, age_labels):
-                if ag in selected_town_data.columns: # データに年齢区分の列が存在するか確認
-                    population = selected_town_data[ag].iloc[0]
-                    population_values.append(population if not pd.isnull(population) else 0)
-                    actual_age_labels.append(label)
-                else:
-                    # 列が存在しない場合でもリストに0を追加して揃える
-                    population_values.append(0)
-                    actual_age_labels.append(label)
-
-            # 年齢区分と人口をデータフレームにまとめる
-            df = pd.DataFrame({'AgeGroup': actual_age_labels, 'Population': population_values})
             # 年齢層別の棒グラフを作成
-            fig = px.bar(df, x='AgeGroup', y='Population', title=f'{town_name}の年齢層別人口')
-            # グラフの見た目を調整（タイトルの位置やフォント、軸のラベルなど）
-            fig.update_layout(
-                title={
-                    'text': f'{town_name}の年齢層別人口',  # タイトルテキスト
-                    'x': 0.503,  # タイトルの水平位置を調整
-                    'xanchor': 'center',  # 中央揃え
-                    'font': {'size': 14}  # タイトルフォントサイズ
-                },
-                xaxis_title='', # x軸のタイトルを非表示
-                yaxis_title='', # y軸のタイトルを非表示
-                xaxis_tickangle=45) # x軸ラベルを45度回転して表示
+            with span('bar_figure_build'):
+                fig = build_bar_figure(town_name, profile)
             logging.info("Bar plot updated successfully.")
-            print("Bar plot updated successfully.")
             # 作成した棒グラフを返す
             return fig
 
         except Exception as e:
             # 例外が発生した場合、エラーログを出力し空のグラフを返す
             logging.exception("バープロットの更新中にエラーが発生しました。")
-            print("バープロットの更新中にエラーが発生しました。")
+            increment('callback_errors_total', callback='update_bar', error=type(e).__name__)
+            figure_cache.skip()
             return go.Figure()
+
+    # 地図と棒グラフの応答は入力が同じなら同じなので、シリアライズ済みの応答をキャッシュする（figure_cache.py）
+    figure_cache.cacheable('..mapPlot.figure...map_state.data..', _map_cache_key)
+    figure_cache.cacheable('barPlot.figure', _bar_cache_key)
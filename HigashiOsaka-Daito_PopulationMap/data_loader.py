@@ -1,109 +1,146 @@
 # data_loader.py
 
 import os
+import re
+import csv
+import json
+import hashlib
+import threading
+import contextlib
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import logging
+from instrumentation import span
+try:
+    import fcntl  # ファイルロック（Windows以外）
+except ImportError:
+    fcntl = None
+    import msvcrt  # ファイルロック（Windows）
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 環境変数 POPMAP_DATA_DIR でデータの置き場所を変更できる（既定はこのファイルと同じ場所の data/）
+DATA_DIR = os.environ.get('POPMAP_DATA_DIR') or os.path.join(BASE_DIR, "data")
+
+# 年次の人口データのファイル名（例: daitou_population_2020.csv）。年ごとの比較に使う（time_series.py）
+YEAR_FILE_PATTERN = re.compile(r'_population_(\d{4})\.csv$', re.IGNORECASE)
+
+# 面積・距離・簡略化などメートル単位の計算に使う投影座標系
+# 元のシェイプファイル（.prj）と同じ平面直角座標系VI系（JGD2000）。データを別の地域に差し替える場合はここを変える
+PROJECTED_CRS = 'EPSG:2448'
+
+# 元データとして扱うファイルの拡張子（CSVとシェイプファイル一式）
+SOURCE_EXTENSIONS = ('.csv', '.shp', '.dbf', '.shx', '.prj', '.cpg')
+
+# build_data.py が書き出すコンパイル済みデータの形式バージョン。
+# 列の構成や前処理の内容を変えたら上げること（古い成果物は自動的に使われなくなる）
+COMPILED_SCHEMA_VERSION = 2
+
+# 以前から使われている組み合わせビューの名前と、それを構成する市区町村の対応
+# （normalize_city で構成する市区町村を並べた名前（daitou+higashiosaka）にそろえるので、キャッシュは1つだけ持つ）
+CITY_COMBINATIONS = {
+    'higashiosaka_daitou': ['higashiosaka', 'daitou'],
+}
+
+# 任意の組み合わせビューの名前で市区町村名を区切る文字（例: daitou+higashiosaka）
+CITY_SEPARATOR = '+'
+
+# 組み合わせビューを構成する市区町村を並列に読み込む際のワーカー数と種類（'thread' または 'process'）
+# 読み込み処理の多くはGILを握ったままになるため、市区町村が多い場合は 'process' の方が速い
+LOAD_WORKERS = int(os.environ.get('POPMAP_LOAD_WORKERS', '4'))
+LOAD_EXECUTOR = os.environ.get('POPMAP_LOAD_EXECUTOR', 'thread')
+
+# キャッシュに保持するデータセット数の上限（市区町村単体と組み合わせビューの合計）
+CACHE_MAX_ENTRIES = int(os.environ.get('POPMAP_CACHE_MAX_ENTRIES', '8'))
+
+# 省メモリ表現（POPMAP_COMPACT=1 で有効）。アプリで使う列だけを残し、人数の列を小さい型に、名前をカテゴリ型にする
+COMPACT = os.environ.get('POPMAP_COMPACT', '').lower() in ('1', 'true', 'yes', 'on')
+# 省メモリ表現で残す列（このほかに5歳階級×性別の列とジオメトリを残す）
+COMPACT_COLUMNS = ['town_name', 'cityname', 'population_total', 'male_total', 'female_total']
+# カテゴリ型にする文字列の列
+CATEGORY_COLUMNS = ['town_name', 'cityname']
+
+# 市区町村名（または組み合わせビュー名）→ {'signature': 元ファイルの状態, 'data': GeoDataFrame, 'derived': 派生データ}
+_cache = OrderedDict()
+_cache_lock = threading.RLock()
+# 同じデータセットを複数スレッドが同時に読み込まないようにするためのキー単位のロック
+_load_locks = defaultdict(threading.Lock)
+# データセット → {'before': 変換前のバイト数, 'after': 変換後のバイト数, 'columns_before', 'columns_after'}
+_memory_stats = {}
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+def population_years(municipality_name):
+    # 年次の人口データがある年のリスト（昇順）
+    data_dir = os.path.join(DATA_DIR, municipality_name)
+    years = []
+    for file in os.listdir(data_dir):
+        match = YEAR_FILE_PATTERN.search(file)
+        if match and file.lower().startswith(municipality_name.lower()):
+            years.append(int(match.group(1)))
+    return sorted(set(years))
+
+def population_file(municipality_name, year=None):
+    # 人口データ（CSV）のパス。year を省略すると <市区町村名>_population.csv、
+    # それがなく年次のファイルだけがある場合は最も新しい年のファイル
+    data_dir = os.path.join(DATA_DIR, municipality_name)
+    if year is None:
+        pop_file = os.path.join(data_dir, f"{municipality_name}_population.csv")
+        years = population_years(municipality_name) if os.path.isdir(data_dir) else []
+        if os.path.exists(pop_file) or not years:
+            return pop_file
+        year = years[-1]
+    return os.path.join(data_dir, f"{municipality_name}_population_{year}.csv")
+
+def read_population_csv(pop_file):
+    # 人口データ（CSV）を読み込み、列名を整えて町名を正規化する
+    # CSVファイルを読み込む（エンコーディングは必要に応じて変更）
+    with span('csv_read'):
+        population_data = pd.read_csv(pop_file, encoding='utf-8')
+    logging.debug("Population data columns before processing: %s", population_data.columns.tolist())
+
+    # 列名を加工して整える
+    population_data.rename(columns={'NAME': 'town_name'}, inplace=True)
+    population_data.columns = population_data.columns.str.replace(r'[\n\r\s　]+', '', regex=True).str.lower()
+    population_data.columns = population_data.columns.str.replace('歳', '', regex=False)
+
+    if 'town_name' not in population_data.columns:
+        logging.error("'town_name' 列が population_data に存在しません。")
+        raise KeyError("'town_name' 列が population_data に存在しません。")
+
+    # 年齢層ごとの集計値は列として持たず、必要になったときに bands.py で5歳階級の列から計算する
+
+    # 列名を簡潔に変更
+    population_data.rename(columns={
+        '人口総数': 'population_total',
+        '男性総数': 'male_total',
+        '女性総数': 'female_total'
+    }, inplace=True)
+    # シェイプファイルの町名と照合できるように、前後の空白を除いて小文字にそろえる
+    population_data['town_name'] = population_data['town_name'].str.strip().str.lower()
+
+    logging.debug("Final population_data columns: %s", population_data.columns.tolist())
+    return population_data
 
 def load_municipality_data(municipality_name):
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    data_dir = os.path.join(BASE_DIR, "data", municipality_name)
+    data_dir = os.path.join(DATA_DIR, municipality_name)
     
-    logging.debug(f"Loading data for municipality: {municipality_name}")
-    print(f"Loading data for municipality: {municipality_name}")
+    logging.debug("Loading data for municipality: %s", municipality_name)
     
     # CSVファイルを指定
-    pop_file = os.path.join(data_dir, f"{municipality_name}_population.csv")
+    pop_file = population_file(municipality_name)
     try:
-        # CSVファイルを読み込む（エンコーディングは必要に応じて変更）
-        population_data = pd.read_csv(pop_file, encoding='utf-8')
-        logging.debug(f"Population data columns before processing: {population_data.columns.tolist()}")
-        print(f"Population data columns before processing: {population_data.columns.tolist()}")
-        
-        # 列名を加工して整える
-        population_data.rename(columns={'NAME': 'town_name'}, inplace=True)
-        population_data.columns = population_data.columns.str.replace(r'[\n\r\s　]+', '', regex=True).str.lower()
-        population_data.columns = population_data.columns.str.replace('歳', '', regex=False)
-        
-        if 'town_name' not in population_data.columns:
-            logging.error("'town_name' 列が population_data に存在しません。")
-            print("'town_name' 列が population_data に存在しません。")
-            raise KeyError("'town_name' 列が population_data に存在しません。")
-        
-        # 年齢別変数の生成
-        population_data = population_data.assign( # 年齢区分や性別ごとの集計値を新たな列として追加
-            age_0_4=population_data['０～４'],
-            age_5_9=population_data['５～９'],
-            age_10_14=population_data['１０～１４'],
-            age_15_19=population_data['１５～１９'],
-            age_20_24=population_data['２０～２４'],
-            age_25_29=population_data['２５～２９'],
-            age_30_34=population_data['３０～３４'],
-            age_35_39=population_data['３５～３９'],
-            age_40_44=population_data['４０～４４'],
-            age_45_49=population_data['４５～４９'],
-            age_50_54=population_data['５０～５４'],
-            age_55_59=population_data['５５～５９'],
-            age_60_64=population_data['６０～６４'],
-            age_65_69=population_data['６５～６９'],
-            age_70_74=population_data['７０～７４'],
-            age_over_75=population_data['７５以上'],
-            
-            male_age_under_10=population_data['男０～４'] + population_data['男５～９'],
-            male_age_10_14=population_data['男１０～１４'],
-            male_age_10_19=population_data['男１０～１４'] + population_data['男１５～１９'],
-            male_age_20_29=population_data['男２０～２４'] + population_data['男２５～２９'],
-            male_age_20_39=population_data['男２０～２４'] + population_data['男２５～２９'] + population_data['男３０～３４'] + population_data['男３５～３９'],
-            male_age_30_39=population_data['男３０～３４'] + population_data['男３５～３９'],
-            male_age_40_49=population_data['男４０～４４'] + population_data['男４５～４９'],
-            male_age_50_59=population_data['男５０～５４'] + population_data['男５５～５９'],
-            male_age_60_69=population_data['男６０～６４'] + population_data['男６５～６９'],
-            male_age_70_74=population_data['男７０～７４'],
-            male_age_over_75=population_data['男７５以上'],
-
-            female_age_under_10=population_data['女０～４'] + population_data['女５～９'],
-            female_age_10_14=population_data['女１０～１４'],
-            female_age_10_19=population_data['女１０～１４'] + population_data['女１５～１９'],
-            female_age_20_29=population_data['女２０～２４'] + population_data['女２５～２９'],
-            female_age_20_39=population_data['女２０～２４'] + population_data['女２５～２９'] + population_data['女３０～３４'] + population_data['女３５～３９'],
-            female_age_30_39=population_data['女３０～３４'] + population_data['女３５～３９'],
-            female_age_40_49=population_data['女４０～４４'] + population_data['女４５～４９'],
-            female_age_50_59=population_data['女５０～５４'] + population_data['女５５～５９'],
-            female_age_60_69=population_data['女６０～６４'] + population_data['女６５～６９'],
-            female_age_70_74=population_data['女７０～７４'],
-            female_age_over_75=population_data['女７５以上'],
-            
-            #特殊
-            age_under_10=population_data['０～４'] + population_data['５～９'],
-            age_10_19=population_data['１０～１４'] + population_data['１５～１９'],
-            age_20_29=population_data['２０～２４'] + population_data['２５～２９'],
-            age_20_39=population_data['２０～２４'] + population_data['２５～２９'] + population_data['３０～３４'] + population_data['３５～３９'],
-            age_30_39=population_data['３０～３４'] + population_data['３５～３９'],
-            age_40_49=population_data['４０～４４'] + population_data['４５～４９'],
-            age_50_59=population_data['５０～５４'] + population_data['５５～５９'],
-            age_60_69=population_data['６０～６４'] + population_data['６５～６９'],
-        )
-        
-        # 列名を簡潔に変更
-        population_data.rename(columns={
-            '人口総数': 'population_total',
-            '男性総数': 'male_total',
-            '女性総数': 'female_total'
-        }, inplace=True)
-        
-        logging.debug(f"Final population_data columns: {population_data.columns.tolist()}")
-        print(f"Final population_data columns: {population_data.columns.tolist()}")
+        population_data = read_population_csv(pop_file)
     except FileNotFoundError:
         logging.error(f"Population data file not found for {municipality_name}")
-        print(f"Population data file not found for {municipality_name}")
         raise FileNotFoundError(f"Population data file not found for {municipality_name}")
     except KeyError as e:
         logging.error(f"人口データの読み込み中にエラーが発生しました: {e}")
-        print(f"人口データの読み込み中にエラーが発生しました: {e}")
         raise e
     except Exception as e:
         logging.error(f"人口データの読み込み中にエラーが発生しました: {e}")
-        print(f"人口データの読み込み中にエラーが発生しました: {e}")
         raise e
 
     # シェイプファイルの読み込み
@@ -117,19 +154,17 @@ def load_municipality_data(municipality_name):
         
         if not shape_file:
             logging.error(f"No shapefile found for {municipality_name}")
-            print(f"No shapefile found for {municipality_name}")
             raise FileNotFoundError(f"No shapefile found for {municipality_name}")
 
-        try:
-            map_data_town = gpd.read_file(shape_file, encoding='utf-8')
-        except UnicodeDecodeError:
-            map_data_town = gpd.read_file(shape_file, encoding='shift_jis')
+        with span('shapefile_read'):
+            try:
+                map_data_town = gpd.read_file(shape_file, encoding='utf-8')
+            except UnicodeDecodeError:
+                map_data_town = gpd.read_file(shape_file, encoding='shift_jis')
 
-        logging.debug(f"Shapefile data columns: {map_data_town.columns.tolist()}")
-        print(f"Shapefile data columns: {map_data_town.columns.tolist()}")
+        logging.debug("Shapefile data columns: %s", map_data_town.columns.tolist())
     except Exception as e:
         logging.error(f"シェイプファイルの読み込み中にエラーが発生しました: {e}")
-        print(f"シェイプファイルの読み込み中にエラーが発生しました: {e}")
         raise e
 
     # マージ用の列を探す
@@ -139,25 +174,531 @@ def load_municipality_data(municipality_name):
 
     if not merge_left_on:
         logging.error(f"シェイプファイル内にマージ用の列が見つかりませんでした ({municipality_name})")
-        print(f"シェイプファイル内にマージ用の列が見つかりませんでした ({municipality_name})")
-        print(f"利用可能な列名: {map_data_town.columns.tolist()}")
+        logging.error("利用可能な列名: %s", map_data_town.columns.tolist())
         raise KeyError("マージ用の列がシェイプファイルに存在しません。")
 
     try:
-        population_data['town_name'] = population_data['town_name'].str.strip().str.lower()
-        map_data_town[merge_left_on] = map_data_town[merge_left_on].astype(str).str.strip().str.lower()
-        map_data_town = map_data_town.merge(population_data, left_on=merge_left_on, right_on='town_name', how='left')
-        logging.debug(f"After merge, map_data_town columns: {map_data_town.columns.tolist()}")
-        print(f"After merge, map_data_town columns: {map_data_town.columns.tolist()}")
+        with span('merge'):
+            map_data_town[merge_left_on] = map_data_town[merge_left_on].astype(str).str.strip().str.lower()
+            map_data_town = map_data_town.merge(population_data, left_on=merge_left_on, right_on='town_name', how='left')
+        logging.debug("After merge, map_data_town columns: %s", map_data_town.columns.tolist())
     except Exception as e:
         logging.error(f"データのマージ中にエラーが発生しました: {e}")
-        print(f"データのマージ中にエラーが発生しました: {e}")
         raise e
 
     logging.info("データのマージが完了しました。")
-    print("データのマージが完了しました。")
 
-    logging.debug(f"Final map_data_town columns: {map_data_town.columns.tolist()}")
-    print(f"Final map_data_town columns: {map_data_town.columns.tolist()}")
+    logging.debug("Final map_data_town columns: %s", map_data_town.columns.tolist())
 
     return map_data_town
+
+
+
+# ---- データセットキャッシュ ----
+# コールバックのたびにCSV・シェイプファイルを読み直さないよう、マージ済みのGeoDataFrameを
+# プロセス内に保持する。元ファイルの更新日時とサイズをキーに含めるので、データを差し替えれば自動で読み直される。
+# 返したGeoDataFrameは他のリクエストと共有されるため、呼び出し側で書き換えないこと。
+
+def _source_signature(municipality_name):
+    # 市区町村ディレクトリ内の元ファイル（CSV・シェイプファイル一式）の (ファイル名, 更新日時, サイズ) の組
+    data_dir = os.path.join(DATA_DIR, municipality_name)
+    try:
+        files = sorted(os.listdir(data_dir))
+    except FileNotFoundError:
+        return ()
+    signature = []
+    for file in files:
+        if file.startswith('~$') or not file.lower().startswith(municipality_name.lower()):
+            continue
+        if not file.lower().endswith(SOURCE_EXTENSIONS):
+            continue
+        st = os.stat(os.path.join(data_dir, file))
+        signature.append((file, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+def city_components(city):
+    # 組み合わせビューなら構成する市区町村のリスト、単体の市区町村ならそれ自身のみのリストを返す
+    # 市区町村名は data/ 以下のディレクトリ名としてパスに使うため、ディレクトリの外を指す名前は受け付けない
+    if city in CITY_COMBINATIONS:
+        return list(CITY_COMBINATIONS[city])
+    components = city.split(CITY_SEPARATOR)
+    for name in components:
+        if name in ('', '.', '..') or os.sep in name or (os.altsep and os.altsep in name):
+            raise ValueError(f"市区町村名として使えない名前です: {name!r}")
+    return components
+
+def city_signature(city):
+    return tuple(_source_signature(name) for name in city_components(city))
+
+_executor = None
+
+def _load_executor():
+    global _executor
+    with _cache_lock:
+        if _executor is None:
+            if LOAD_EXECUTOR == 'process':
+                _executor = ProcessPoolExecutor(max_workers=LOAD_WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=LOAD_WORKERS, thread_name_prefix='popmap-load')
+        return _executor
+
+def _load_components(components):
+    # キャッシュにない市区町村だけをワーカーで並列に読み込み、キャッシュに登録する
+    # 全体の時間は、市区町村数の合計ではなく最も遅い市区町村の読み込み時間程度になる
+    frames = {}
+    missing = []
+    for name in components:
+        signature = (_source_signature(name),)
+        data = _cache_lookup(name, signature)
+        if data is None:
+            missing.append((name, signature))
+        else:
+            frames[name] = data
+    if len(missing) == 1:
+        name, signature = missing[0]
+        frames[name] = get_municipality_data(name)
+    elif missing:
+        # _get_cached と同じ市区町村ごとのロックを取り、同時に来たリクエストが同じ市区町村を重ねて読み込まないようにする
+        # （デッドロックしないようにロックは名前順に取る。待っている間に読み込まれたものはキャッシュから使う）
+        with contextlib.ExitStack() as stack:
+            for name, _ in sorted(missing):
+                with _cache_lock:
+                    load_lock = _load_locks[name]
+                stack.enter_context(load_lock)
+            pending = []
+            for name, signature in missing:
+                data = _cache_lookup(name, signature)
+                if data is None:
+                    pending.append((name, signature))
+                else:
+                    frames[name] = data
+            results = _load_executor().map(_build_municipality_data, [name for name, _ in pending])
+            for (name, signature), data in zip(pending, results):
+                data = _finish_dataset(name, data)
+                _cache_store(name, signature, data)
+                frames[name] = data
+    return [frames[name] for name in components]
+
+def _reset_after_fork():
+    # fork 後の子プロセスには親のスレッドが存在しないため、スレッドプールとロックを作り直す
+    global _executor, _cache_lock
+    _executor = None
+    _cache_lock = threading.RLock()
+    _load_locks.clear()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _cache_lookup(key, signature):
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry['signature'] == signature:
+            _cache.move_to_end(key)
+            _cache_stats['hits'] += 1
+            return entry['data']
+        return None
+
+def _cache_store(key, signature, data):
+    with _cache_lock:
+        _cache_stats['misses'] += 1
+        _cache[key] = {'signature': signature, 'data': data, 'derived': {}}
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_MAX_ENTRIES:
+            evicted, _ = _cache.popitem(last=False)
+            _cache_stats['evictions'] += 1
+            logging.debug("Evicted cached dataset: %s", evicted)
+
+def _get_cached(key, signature, build):
+    data = _cache_lookup(key, signature)
+    if data is not None:
+        return data
+    with _cache_lock:
+        load_lock = _load_locks[key]
+    with load_lock:
+        # ロック待ちの間に他のスレッドが読み込み終えていればそれを使う
+        data = _cache_lookup(key, signature)
+        if data is not None:
+            return data
+        data = build()
+        _cache_store(key, signature, data)
+        return data
+
+def _build_municipality_data(municipality_name):
+    # コンパイル済みデータが最新ならそれを使い、古い・存在しない場合のみ元ファイルを読み込む
+    data = load_compiled_data(municipality_name)
+    if data is not None:
+        return data
+    data = load_municipality_data(municipality_name)
+    # 地図描画で使うEPSG:4326への変換はキャッシュ時に一度だけ行う
+    if data.crs is not None and data.crs != "EPSG:4326":
+        with span('crs_transform'):
+            data = data.to_crs(epsg=4326)
+    return data
+
+# ---- コンパイル済みデータ（GeoParquet） ----
+# シェイプファイルの解析・文字コードの判定・集計・マージ・座標変換を済ませた結果を
+# 市区町村ごとに1ファイルの列指向形式で保存しておき、起動時やキャッシュミス時はそれを読むだけにする。
+
+def _compiled_paths(municipality_name):
+    data_dir = os.path.join(DATA_DIR, municipality_name)
+    return (os.path.join(data_dir, f"{municipality_name}.parquet"),
+            os.path.join(data_dir, f"{municipality_name}.build.json"))
+
+def _source_digest(municipality_name):
+    # 元ファイルの内容のハッシュ。git checkout 等で更新日時だけが変わっても再ビルド不要と判定できるようにする
+    data_dir = os.path.join(DATA_DIR, municipality_name)
+    digest = hashlib.sha256()
+    for file, _, _ in _source_signature(municipality_name):
+        digest.update(file.encode('utf-8'))
+        with open(os.path.join(data_dir, file), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def _read_build_stamp(municipality_name):
+    _, stamp_file = _compiled_paths(municipality_name)
+    try:
+        with open(stamp_file, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def compiled_data_is_fresh(municipality_name):
+    parquet_file, _ = _compiled_paths(municipality_name)
+    stamp = _read_build_stamp(municipality_name)
+    if stamp is None or not os.path.exists(parquet_file):
+        return False
+    if stamp.get('schema_version') != COMPILED_SCHEMA_VERSION:
+        return False
+    return stamp.get('source_digest') == _source_digest(municipality_name)
+
+_WGS84 = None
+
+def _read_compiled(parquet_file):
+    # コンパイル済みデータは必ず EPSG:4326 で書き出しているので、ファイル内の座標系の定義（PROJJSON）は解析せず
+    # 一度だけ作成した座標系オブジェクトを使う（解析はGILを握ったまま時間がかかり、並列読み込みの妨げになる）
+    global _WGS84
+    import pyarrow.parquet as pq
+    from pyproj import CRS
+    if _WGS84 is None:
+        _WGS84 = CRS.from_epsg(4326)
+    frame = pq.read_table(parquet_file).to_pandas()
+    geometry = gpd.GeoSeries.from_wkb(frame.pop('geometry'), crs=_WGS84)
+    return gpd.GeoDataFrame(frame, geometry=geometry)
+
+def load_compiled_data(municipality_name):
+    # 最新のコンパイル済みデータがあれば読み込んで返し、なければ None を返す
+    parquet_file, _ = _compiled_paths(municipality_name)
+    if not os.path.exists(parquet_file):
+        return None
+    if not compiled_data_is_fresh(municipality_name):
+        logging.info("Compiled data for %s is stale. Falling back to source files.", municipality_name)
+        return None
+    try:
+        with span('compiled_read'):
+            data = _read_compiled(parquet_file)
+    except ImportError as e:  # pyarrow が入っていない環境
+        logging.warning(f"コンパイル済みデータを読み込めません（{e}）。元ファイルを使用します。")
+        return None
+    logging.debug("Loaded compiled data for municipality: %s", municipality_name)
+    return data
+
+def compile_municipality_data(municipality_name, force=False):
+    # 元ファイルを読み込んで前処理し、コンパイル済みデータとビルド情報を書き出す。書き出したら True を返す
+    if not force and compiled_data_is_fresh(municipality_name):
+        logging.info("Compiled data for %s is up to date.", municipality_name)
+        return False
+    source_digest = _source_digest(municipality_name)
+    data = load_municipality_data(municipality_name)
+    if data.crs is not None and data.crs != "EPSG:4326":
+        data = data.to_crs(epsg=4326)
+
+    parquet_file, stamp_file = _compiled_paths(municipality_name)
+    # 他のプロセスが読み込み中でも壊れたファイルを読まないように、一時ファイルに書き出してから置き換える
+    data.to_parquet(parquet_file + '.tmp', index=False)
+    os.replace(parquet_file + '.tmp', parquet_file)
+    with open(stamp_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({
+            'schema_version': COMPILED_SCHEMA_VERSION,
+            'municipality': municipality_name,
+            'source_digest': source_digest,
+            'crs': 'EPSG:4326',
+            'rows': int(len(data)),
+        }, f, ensure_ascii=False, indent=2)
+    os.replace(stamp_file + '.tmp', stamp_file)
+    logging.info("Compiled data written: %s", parquet_file)
+    return True
+
+@contextlib.contextmanager
+def _file_lock(path):
+    # プロセス間の排他ロック（同じファイルをロックしようとした他のプロセスは、解放されるまで待つ）
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK は約10秒で諦めるので、取れるまで繰り返す
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def ensure_compiled_data(municipality_name):
+    # 最新のコンパイル済みデータがなければ作成する。作成したら True を返す
+    # 複数のプロセス（ワーカーやバックグラウンドのジョブ）が同時に呼んでも、ファイルロックで作成は1回だけ行い、
+    # 待っていた側はロックを取った後に最新になっていることを確認して何もしない
+    if compiled_data_is_fresh(municipality_name):
+        return False
+    _, stamp_file = _compiled_paths(municipality_name)
+    with _file_lock(stamp_file + '.lock'):
+        return compile_municipality_data(municipality_name)
+
+# ---- 省メモリ表現 ----
+# マージ済みのデータにはシェイプファイルの属性列や、人口データの使わない列も残っている。
+# 複数ワーカーで配信する場合はワーカーあたりの常駐メモリで同時に動かせる数が決まるため、
+# POPMAP_COMPACT=1 のときはキャッシュに登録する前に必要な列だけの小さい表現に変換する。
+# コンパイル済みデータ（build_data.py の出力）は変えず、読み込み後に変換する
+
+def compact_columns():
+    from age_profiles import age_columns
+    columns = list(COMPACT_COLUMNS)
+    for sex in ('total', 'male', 'female'):
+        columns += age_columns(sex)
+    return columns
+
+def _downcast(series):
+    # 人数の列を値が収まる最小の型にする
+    # 欠損値（人口データと結合できなかった町）を含む列は整数型にできないため、値を正確に表せる範囲なら float32 にする
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.to_numeric(series, downcast='integer')
+    if pd.api.types.is_float_dtype(series.dtype):
+        values = series.to_numpy()
+        finite = values[~np.isnan(values)]
+        if finite.size and not np.array_equal(finite, np.round(finite)):
+            return series
+        if finite.size == values.size:
+            return pd.to_numeric(series, downcast='integer')
+        if finite.size == 0 or np.abs(finite).max() < 2 ** 24:
+            return series.astype(np.float32)
+    return series
+
+def compact_data(data):
+    # 使う列だけを残し、人数の列を小さい型に、名前の列をカテゴリ型に変換したデータを返す
+    keep = [column for column in compact_columns() if column in data.columns]
+    compact = data[keep + [data.geometry.name]].copy()
+    for column in keep:
+        if column in CATEGORY_COLUMNS:
+            compact[column] = compact[column].astype('category')
+        else:
+            compact[column] = _downcast(compact[column])
+    return compact
+
+def _geometry_memory(data):
+    # ジオメトリのおおよそのメモリ使用量（座標数×16バイト）
+    import shapely
+    return int(shapely.get_num_coordinates(data.geometry.to_numpy()).sum()) * 16
+
+def dataset_memory(data):
+    # データセットのおおよそのメモリ使用量（バイト）。ジオメトリは座標数×16バイトで見積もる
+    usage = data.memory_usage(deep=True, index=True)
+    return int(usage.drop(data.geometry.name, errors='ignore').sum()) + _geometry_memory(data)
+
+def _finish_dataset(key, data, before=None, columns_before=None):
+    # キャッシュに登録する直前の処理（省メモリ表現が有効なら変換し、変換前後のメモリ使用量を記録する）
+    # before・columns_before を省略すると data（変換前）から求める
+    if not COMPACT:
+        return data
+    before = dataset_memory(data) if before is None else before
+    columns_before = len(data.columns) if columns_before is None else columns_before
+    data = compact_data(data)
+    after = dataset_memory(data)
+    with _cache_lock:
+        _memory_stats[key] = {'before': before, 'after': after,
+                              'columns_before': columns_before, 'columns_after': len(data.columns)}
+    logging.info("Compacted %s: %d columns -> %d, %.1f KB -> %.1f KB",
+                 key, columns_before, len(data.columns), before / 1024, after / 1024)
+    return data
+
+def get_municipality_data(municipality_name):
+    # キャッシュ経由で市区町村単体のデータを取得する（EPSG:4326に変換済み）
+    signature = (_source_signature(municipality_name),)
+    return _get_cached(municipality_name, signature,
+                       lambda: _finish_dataset(municipality_name, _build_municipality_data(municipality_name)))
+
+def get_city_data(city):
+    # キャッシュ経由で市区町村単体または組み合わせビューのデータを取得する
+    # （以前の組み合わせビューの名前も同じ名前にそろえ、同じデータを二重に持たない）
+    city = normalize_city(city)
+    components = city_components(city)
+    if len(components) == 1:
+        return get_municipality_data(components[0])
+
+    def build():
+        # 各市のデータを並列に読み込んでから結合する
+        # 市区町村ごとにカテゴリの値が異なると結合後は文字列の列に戻るため、省メモリ表現では結合後にもう一度変換する
+        frames = _load_components(components)
+        data = pd.concat(frames, ignore_index=True)
+        if not COMPACT:
+            return data
+        # 組み合わせビューは構成する市区町村とは別に、結合した行の列のコピーをキャッシュに持つ
+        # （ジオメトリのオブジェクトは市区町村のデータと共有するので、座標は二重に持たない）。
+        # 構成する市区町村はすでに変換済みのため、変換前のメモリ使用量は変換前の市区町村のデータを結合した場合の値
+        # （各市区町村の変換前の値の合計）とし、共有しているジオメトリの分を除いた値（'own'）も記録する
+        with _cache_lock:
+            stats = [_memory_stats.get(name) for name in components]
+        before = sum(s['before'] if s else dataset_memory(frame) for s, frame in zip(stats, frames))
+        columns_before = max(s['columns_before'] if s else len(frame.columns) for s, frame in zip(stats, frames))
+        data = _finish_dataset(city, data, before=before, columns_before=columns_before)
+        with _cache_lock:
+            if city in _memory_stats:
+                _memory_stats[city]['own'] = _memory_stats[city]['after'] - _geometry_memory(data)
+        return data
+
+    return _get_cached(city, city_signature(city), build)
+
+def city_data_ready(city):
+    # データをすぐに用意できるか（キャッシュに読み込み済み、またはすべての市区町村のコンパイル済みデータが最新）
+    # False の場合は元ファイルの読み込み・マージ・座標変換が必要で時間がかかる
+    city = normalize_city(city)
+    with _cache_lock:
+        entry = _cache.get(_cache_key(city))
+    if entry is not None and entry['signature'] == city_signature(city):
+        return True
+    for name in city_components(city):
+        with _cache_lock:
+            entry = _cache.get(name)
+        if entry is not None and entry['signature'] == (_source_signature(name),):
+            continue
+        if not compiled_data_is_fresh(name):
+            return False
+    return True
+
+def _cache_key(city):
+    return normalize_city(city)
+
+def get_derived(city, kind, build):
+    # GeoJSONや集計行列など、データセットから一度だけ計算すればよい派生データを取得する
+    # 派生データはデータセットと同じキャッシュ項目に保持され、元ファイルの更新や追い出しの際に一緒に破棄される
+    data = get_city_data(city)
+    key = _cache_key(city)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry['data'] is data and kind in entry['derived']:
+            return entry['derived'][kind]
+    value = build(data)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry['data'] is data:
+            value = entry['derived'].setdefault(kind, value)
+    return value
+
+def invalidate_cache(name=None):
+    # name を省略すると全件、指定するとその市区町村と、それを含む組み合わせビューを破棄する
+    with _cache_lock:
+        if name is None:
+            keys = list(_cache)
+        else:
+            keys = [key for key in _cache if key == name or name in city_components(key)]
+        for key in keys:
+            del _cache[key]
+        _cache_stats['invalidations'] += len(keys)
+    return keys
+
+def warm_cache(cities=None):
+    # 指定した（省略時は data/ 以下のすべての市区町村と既定の組み合わせビューの）データを事前に読み込む
+    if cities is None:
+        cities = list(discover_municipalities())
+        for components in CITY_COMBINATIONS.values():
+            if all(name in cities for name in components):
+                cities.append(normalize_city(components))
+    for city in cities:
+        get_city_data(city)
+    return cities
+
+def cache_info():
+    with _cache_lock:
+        return dict(_cache_stats, size=len(_cache), maxsize=CACHE_MAX_ENTRIES, keys=list(_cache),
+                    compact=COMPACT, memory={key: dict(stats) for key, stats in _memory_stats.items()})
+
+
+# ---- 市区町村レジストリ ----
+# data/<市区町村名>/ に <市区町村名>_population.csv（または年次の <市区町村名>_population_<年>.csv）と
+# <市区町村名>.shp を置けば、その市区町村が自動的に選択肢に加わる
+
+_registry = {'mtime': None, 'municipalities': {}}
+
+def _display_name(municipality_name):
+    # 人口データ（CSV）の CITYNAME 列の値を表示名に使う（読めない場合は市区町村名そのもの）
+    pop_file = population_file(municipality_name)
+    for encoding in ('utf-8-sig', 'shift_jis'):
+        try:
+            with open(pop_file, encoding=encoding, newline='') as f:
+                row = next(csv.DictReader(f), None)
+            if row and row.get('CITYNAME'):
+                return row['CITYNAME'].strip()
+            break
+        except UnicodeDecodeError:
+            continue
+    return municipality_name
+
+def discover_municipalities():
+    # data/ 以下の市区町村を探し、{市区町村名: 表示名} を市区町村名の順で返す
+    # data/ と各サブディレクトリの更新日時が前回と同じなら前回の結果を使う
+    # （既存のディレクトリにファイルを追加した場合は、そのディレクトリの更新日時だけが変わる）
+    with os.scandir(DATA_DIR) as entries:
+        mtime = (os.stat(DATA_DIR).st_mtime_ns,
+                 tuple(sorted((entry.name, entry.stat().st_mtime_ns) for entry in entries if entry.is_dir())))
+    with _cache_lock:
+        if _registry['mtime'] == mtime:
+            return dict(_registry['municipalities'])
+    municipalities = {}
+    for name in sorted(os.listdir(DATA_DIR)):
+        data_dir = os.path.join(DATA_DIR, name)
+        if not os.path.isdir(data_dir):
+            continue
+        files = {file.lower() for file in os.listdir(data_dir)}
+        has_population = f"{name}_population.csv".lower() in files or any(
+            YEAR_FILE_PATTERN.search(file) and file.startswith(name.lower()) for file in files)
+        if has_population and f"{name}.shp".lower() in files:
+            municipalities[name] = _display_name(name)
+    with _cache_lock:
+        _registry['mtime'] = mtime
+        _registry['municipalities'] = municipalities
+    return dict(municipalities)
+
+def normalize_city(value):
+    # ドロップダウンの値（市区町村名のリスト、または市区町村名・組み合わせビュー名）を
+    # データの取得やキャッシュのキーに使う名前に変換する。順番が違っても同じ組み合わせは同じ名前になる
+    # 以前の組み合わせビューの名前（higashiosaka_daitou）も、構成する市区町村を並べた名前に変換する
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(CITY_SEPARATOR)
+    names = sorted(dict.fromkeys(name for item in value for name in CITY_COMBINATIONS.get(item, [item])))
+    return names[0] if len(names) == 1 else CITY_SEPARATOR.join(names)
+
+def resolve_city(values):
+    # 外部から指定された市区町村名（'daitou+higashiosaka'・'daitou,higashiosaka' などの文字列、またはそのリスト）を
+    # 正規化した名前に変換する。data/ 以下に存在しない市区町村名を含む場合はファイルの読み込みに使わずに None を返す
+    if isinstance(values, str):
+        values = [values]
+    names = [name for value in values or [] if isinstance(value, str) for name in re.split(r'[+\s,]+', value) if name]
+    city = normalize_city(names)
+    if city is None:
+        return None
+    known = discover_municipalities()
+    if not all(name in known for name in city_components(city)):
+        return None
+    return city
+
+def city_display_name(city):
+    names = discover_municipalities()
+    return '＆'.join(names.get(name, name) for name in city_components(city))
@@ -0,0 +1,98 @@
+# derived_metrics.py
+
+# 人数から求める派生指標（人口密度・割合・老年化指数・従属人口指数）
+# 指標は変数名の形（接尾辞）で表し、選択されたときに町ごとの値の配列どうしの演算で計算する。
+# 計算結果はデータセット・指標ごとにメモ化し、読み込み時には列を追加しない。
+# 町の面積は投影座標系で一度だけ計算し、ジオメトリと同じキャッシュ項目に保持する
+#
+# 変数名の形:
+#   <変数>_per_km2   人口密度（人/km²）      例: population_total_per_km2, age_20_39_per_km2
+#   <変数>_share     総人口に占める割合（%）  例: age_over_65_share
+#   aging_index / dependency_ratio
+
+import re
+
+import numpy as np  # 数値配列を扱うライブラリ
+from data_loader import get_derived, PROJECTED_CRS
+
+# 指標の値の小数点以下の桁数（地図に送るデータ量を抑える）
+METRIC_DECIMALS = 1
+
+# 比率の指標: 変数名 → (ラベル, 分子の変数, 分母の変数)。値は 分子の合計 / 分母の合計 × 100
+RATIO_METRICS = {
+    'aging_index': ("老年化指数（65歳以上/15歳未満）", ['age_over_65'], ['age_under_15']),
+    'dependency_ratio': ("従属人口指数（(15歳未満+65歳以上)/15-64歳）", ['age_under_15', 'age_over_65'], ['age_15_64']),
+}
+
+# ドロップダウンに表示する派生指標: (ラベル, 変数名)
+FEATURED_METRICS = [
+    ("人口密度（人/km²）", 'population_total_per_km2'),
+    ("男女20-39歳 密度（人/km²）", 'age_20_39_per_km2'),
+    ("10歳未満 密度（人/km²）", 'age_under_10_per_km2'),
+    ("男女20-39歳 割合（%）", 'age_20_39_share'),
+    ("年少人口割合（15歳未満, %）", 'age_under_15_share'),
+    ("高齢化率（65歳以上, %）", 'age_over_65_share'),
+] + [(label, name) for name, (label, _, _) in RATIO_METRICS.items()]
+
+_METRIC_PATTERN = re.compile(r'^(.+)_(per_km2|share)$')
+
+def parse_metric(variable):
+    # 派生指標なら (種類, 元の変数) を返す（種類は 'per_km2'・'share'・'ratio'）。派生指標でなければ None
+    # 元の変数は人口データの列か年齢層に限る（派生指標の派生指標は受け付けない）
+    if variable in RATIO_METRICS:
+        return 'ratio', variable
+    match = _METRIC_PATTERN.match(variable)
+    if match and match.group(1) not in RATIO_METRICS and not _METRIC_PATTERN.match(match.group(1)):
+        return match.group(2), match.group(1)
+    return None
+
+def _build_town_areas(data):
+    # 町ごとの面積（km²、データの行順）。ジオメトリがない行は欠損値
+    areas = np.full(len(data), np.nan)
+    valid = data.geometry.notna().to_numpy()
+    areas[valid] = data.geometry[valid].to_crs(PROJECTED_CRS).area.to_numpy() / 1e6
+    return areas
+
+def town_areas(city):
+    # データセットごとにキャッシュされる
+    return get_derived(city, 'area_km2', _build_town_areas)
+
+def _divide(numerator, denominator, scale=1.0):
+    # 分母が0や欠損値の町は欠損値にする
+    result = np.full(np.broadcast(numerator, denominator).shape, np.nan)
+    np.divide(numerator * scale, denominator, out=result, where=np.isfinite(denominator) & (denominator > 0))
+    return np.round(result, METRIC_DECIMALS)
+
+def evaluate_metric(variable, values_of, areas):
+    # 派生指標の値を計算する
+    # values_of(変数名) は元の変数の値の配列（町の配列、または年次データの 町×年 の配列）を返す関数
+    kind, base = parse_metric(variable)
+    if kind == 'per_km2':
+        values = values_of(base)
+        # 年次データ（町×年）の場合も町ごとの面積で割れるように形をそろえる
+        return _divide(values, areas.reshape((-1,) + (1,) * (values.ndim - 1)))
+    if kind == 'share':
+        return _divide(values_of(base), values_of('population_total'), 100.0)
+    _, numerators, denominators = RATIO_METRICS[base]
+    return _divide(sum(values_of(v) for v in numerators), sum(values_of(v) for v in denominators), 100.0)
+
+def metric_values(city, variable):
+    # 派生指標の町ごとの値（データの行順、float配列）。データセット・指標ごとにメモ化される
+    # 派生指標でない場合や元の変数が人口データの列・年齢層でない場合は KeyError（メモ化しない）
+    from bands import variable_values
+    if parse_metric(variable) is None:
+        raise KeyError(f"派生指標として解釈できません: {variable}")
+    return get_derived(city, ('metric', variable),
+                       lambda data: evaluate_metric(variable, lambda v: variable_values(city, v), town_areas(city)))
+
+def metric_label(variable, label_of):
+    # 派生指標の表示名。label_of(変数名) は元の変数の表示名を返す関数
+    for label, name in FEATURED_METRICS:
+        if name == variable:
+            return label
+    kind, base = parse_metric(variable)
+    if kind == 'per_km2':
+        return f"{label_of(base)} 密度（人/km²）"
+    if kind == 'share':
+        return f"{label_of(base)} 割合（%）"
+    return RATIO_METRICS[base][0]
@@ -0,0 +1,239 @@
+# export.py
+
+# 地図の一括書き出しコマンド
+# 市（組み合わせビューを含む）× 変数のすべての組み合わせ（または指定したもの）の地図を、
+# 画面と同じFigure作成処理（figures.py）で単体のHTMLファイル（kaleido があれば画像も）に書き出す。
+# 書き出しはプロセスプールで並列に行い、各ワーカーはデータセットを一度だけ読み込んで使い回す。
+# 入力（元データ・変数・年・書き出し設定）が前回と同じファイルは書き出さずにスキップする
+#
+# 使い方:
+#   python export.py                                   # すべての市×変数を export/ に書き出す
+#   python export.py --city daitou --variable age_20_39 --format html png
+#   python export.py --year 2020 --workers 8 --force
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import plotly
+import plotly.io as pio
+from data_loader import (discover_municipalities, normalize_city, city_components, city_signature, city_display_name,
+                         warm_cache)
+from bands import build_variable_options, variable_label
+from figures import build_map_figure, build_bar_figure
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 書き出し処理の内容を変えたら上げること（前回の書き出し結果がすべて作り直される）
+EXPORT_VERSION = 1
+
+# 書き出し結果の一覧（出力ファイルの書き出し先からの相対パス → 入力の指紋）
+# 形式ごとに別のエントリなので、画像だけを書き出してもHTMLの記録は上書きされない
+MANIFEST_NAME = 'manifest.json'
+
+# 画像の大きさ（画面の地図とおおよそ同じ）
+IMAGE_SIZE = {'width': 1100, 'height': 700}
+
+# 棒グラフ（市全体の年齢構成）のファイル名
+AGE_PROFILE_NAME = 'age_profile'
+
+def default_cities():
+    # 既定の書き出し対象: data/ 以下の各市区町村と、すべての市区町村を結合したビュー
+    names = list(discover_municipalities())
+    return names + ([normalize_city(names)] if len(names) > 1 else [])
+
+def _fingerprint(city, name, settings):
+    # 出力の入力となるもの（元データの状態・変数・年・書き出し設定）のハッシュ
+    payload = json.dumps({
+        'version': EXPORT_VERSION,
+        'plotly': plotly.__version__,
+        'city': city,
+        'signature': city_signature(city),
+        'name': name,
+        'settings': settings,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def producible_formats(formats):
+    # 指定された形式のうち、この環境で書き出せるもの（画像は kaleido が必要）
+    if any(fmt != 'html' for fmt in formats) and not _has_kaleido():
+        return [fmt for fmt in formats if fmt == 'html']
+    return list(formats)
+
+def _has_kaleido():
+    try:
+        import kaleido  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def _map_figure(city, variable, year):
+    label = variable_label(variable, build_variable_options())
+    if year is not None:
+        label = f"{label}（{year}年）"
+    fig = build_map_figure(city, variable, label, year)
+    # レポート用にタイトルを付ける（画面の地図は余白なし）
+    fig['layout']['title'] = {'text': f"{city_display_name(city)} {label}", 'x': 0.5, 'xanchor': 'center'}
+    fig['layout']['margin'] = {'r': 0, 't': 40, 'l': 0, 'b': 0}
+    return fig
+
+def _age_profile_figure(city):
+    from age_profiles import age_profiles
+    profiles = age_profiles(city)
+    profile = profiles['matrix'].sum(axis=0, dtype='int64')
+    return build_bar_figure(city_display_name(city), profile).to_dict()
+
+def _write(fig, base_path, formats, plotlyjs):
+    # Figureの辞書をそのまま書き出す（GeoJSONを含むため、plotlyの検証によるコピーは行わない）
+    written = []
+    for fmt in formats:
+        path = f"{base_path}.{fmt}"
+        if fmt == 'html':
+            pio.write_html(fig, path, include_plotlyjs=plotlyjs, full_html=True, validate=False)
+        else:
+            pio.write_image(fig, path, format=fmt, validate=False, **IMAGE_SIZE)
+        written.append(path)
+    return written
+
+def _render_jobs(jobs, output_dir, plotlyjs, year):
+    # ワーカープロセスで実行する。同じ市のジョブをまとめて受け取り、データセットはプロセス内のキャッシュを使い回す
+    # ジョブは (市, 変数, 書き出しが必要な形式のリスト)
+    results = []
+    for city, name, formats in jobs:
+        start = time.perf_counter()
+        base_path = os.path.join(output_dir, city, name)
+        try:
+            fig = _age_profile_figure(city) if name == AGE_PROFILE_NAME else _map_figure(city, name, year)
+            paths = _write(fig, base_path, formats, plotlyjs)
+            results.append({'city': city, 'name': name, 'formats': formats, 'paths': paths, 'error': None,
+                            'seconds': time.perf_counter() - start})
+        except Exception as e:
+            logging.exception("%s / %s の書き出し中にエラーが発生しました。", city, name)
+            results.append({'city': city, 'name': name, 'formats': formats, 'paths': [],
+                            'error': f"{type(e).__name__}: {e}",
+                            'seconds': time.perf_counter() - start})
+    return results
+
+def _chunks(jobs, workers):
+    # 市ごとにジョブをまとめ、ワーカー数に応じて分割する（1つの市のジョブが少数のワーカーに集まるようにする）
+    by_city = {}
+    for job in jobs:
+        by_city.setdefault(job[0], []).append(job)
+    size = max(1, -(-len(jobs) // (workers * 2)))
+    for city_jobs in by_city.values():
+        for i in range(0, len(city_jobs), size):
+            yield city_jobs[i:i + size]
+
+def export(cities, variables, output_dir, formats=('html',), workers=None, force=False, year=None,
+           plotlyjs='cdn', age_profile=True):
+    # 書き出しを実行し、{'written', 'skipped', 'failed', 'seconds'} を返す（件数は市×変数の単位）
+    # 書き出せる形式が1つもない場合は ValueError
+    start = time.perf_counter()
+    usable = producible_formats(formats)
+    if len(usable) < len(formats):
+        logging.warning("kaleido がインストールされていないため、画像は書き出しません（pip install kaleido）。")
+    formats = usable
+    if not formats:
+        raise ValueError("書き出せる形式がありません（画像の書き出しには kaleido が必要です）。")
+
+    manifest = _load_manifest(output_dir)
+    jobs, fingerprints, skipped = [], {}, 0
+    for city in cities:
+        os.makedirs(os.path.join(output_dir, city), exist_ok=True)
+        names = list(variables) + ([AGE_PROFILE_NAME] if age_profile else [])
+        for name in names:
+            stale = []
+            for fmt in formats:
+                key = f"{city}/{name}.{fmt}"
+                # 年次データは地図だけに使う（棒グラフは最新のデータ）。plotly.js の読み込み方法はHTMLだけに影響する
+                settings = {'format': fmt, 'plotlyjs': plotlyjs if fmt == 'html' else None,
+                            'year': year if name != AGE_PROFILE_NAME else None}
+                fingerprint = _fingerprint(city, name, settings)
+                if (not force and manifest.get(key) == fingerprint
+                        and os.path.exists(os.path.join(output_dir, city, f"{name}.{fmt}"))):
+                    continue
+                stale.append(fmt)
+                fingerprints[key] = fingerprint
+            if not stale:
+                skipped += 1
+                continue
+            jobs.append((city, name, stale))
+
+    workers = workers or os.cpu_count() or 1
+    written, failed = 0, []
+    if jobs:
+        # fork で起動するプラットフォームでは、親プロセスで読み込んだデータセットをワーカーがそのまま共有する
+        warm_cache(sorted({city for city, _, _ in jobs}))
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            futures = [executor.submit(_render_jobs, chunk, output_dir, plotlyjs, year)
+                       for chunk in _chunks(jobs, workers)]
+            for future in as_completed(futures):
+                for result in future.result():
+                    keys = [f"{result['city']}/{result['name']}.{fmt}" for fmt in result['formats']]
+                    if result['error']:
+                        failed.append(result)
+                        for key in keys:
+                            manifest.pop(key, None)
+                        continue
+                    written += 1
+                    for key in keys:
+                        manifest[key] = fingerprints[key]
+                    logging.info("%s/%s (%.2fs)", result['city'], result['name'], result['seconds'])
+        _save_manifest(output_dir, manifest)
+    return {'written': written, 'skipped': skipped, 'failed': failed, 'seconds': time.perf_counter() - start}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="市×変数の地図をHTML・画像に一括で書き出す")
+    parser.add_argument('--city', action='append', dest='cities',
+                        help="書き出す市（'+' 区切りで組み合わせ。複数指定可）。省略時は各市区町村とすべてを結合したビュー")
+    parser.add_argument('--variable', action='append', dest='variables',
+                        help="書き出す変数（複数指定可）。省略時はドロップダウンのすべての変数")
+    parser.add_argument('--year', type=int, help="年次データの年（省略時は最新のデータ）")
+    parser.add_argument('--output', default=os.path.join(BASE_DIR, 'export'), help="書き出し先のディレクトリ")
+    parser.add_argument('--format', nargs='+', dest='formats', default=['html'], choices=['html', 'png', 'svg', 'pdf'],
+                        help="書き出す形式（画像は kaleido が必要）")
+    parser.add_argument('--plotlyjs', default='cdn', choices=['cdn', 'inline', 'directory'],
+                        help="HTMLからのplotly.jsの読み込み方法（inline はオフラインで表示できるがファイルが大きくなる）")
+    parser.add_argument('--workers', type=int, help="ワーカープロセス数（省略時はCPUコア数）")
+    parser.add_argument('--no-age-profile', action='store_true', help="市全体の年齢構成の棒グラフを書き出さない")
+    parser.add_argument('--force', action='store_true', help="入力が変わっていなくても書き出す")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s:%(message)s')
+
+    cities = [normalize_city(city.split('+')) for city in args.cities] if args.cities else default_cities()
+    known = discover_municipalities()
+    unknown = sorted({name for city in cities for name in city_components(city) if name not in known})
+    if unknown:
+        parser.error(f"data/ 以下に見つからない市区町村です: {', '.join(unknown)}")
+    if not producible_formats(args.formats):
+        parser.error("指定された形式はどれも書き出せません（画像の書き出しには kaleido が必要です: pip install kaleido）")
+    variables = args.variables or list(build_variable_options().values())
+    summary = export(cities, variables, args.output, formats=args.formats, workers=args.workers,
+                     force=args.force, year=args.year, plotlyjs=args.plotlyjs, age_profile=not args.no_age_profile)
+    print(f"written: {summary['written']}, skipped: {summary['skipped']}, failed: {len(summary['failed'])}, "
+          f"{summary['seconds']:.1f}s")
+    for result in summary['failed']:
+        print(f"  {result['city']}/{result['name']}: {result['error']}")
+    return 1 if summary['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
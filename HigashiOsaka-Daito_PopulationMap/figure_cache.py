@@ -0,0 +1,180 @@
+# figure_cache.py
+
+# 地図・棒グラフのコールバックの応答キャッシュ
+# /_dash-update-component の応答本文（シリアライズ済みのJSONと、それをgzip圧縮したもの）を
+# コールバックごとのキー（市・変数・年・町など）と元データの状態（data_loader.city_signature）の組で保持し、
+# 同じ内容のリクエストにはコールバックを呼ばず、Figureの作成もJSONへの変換もせずにそのまま返す。
+# 元データを差し替えるとキーが変わるので、古い応答は使われなくなり、やがて追い出される。
+# 保持する応答の合計サイズが上限を超えたら、最も長く使われていないものから捨てる。
+# どのコールバックをどのキーでキャッシュするかは callbacks.py で cacheable() により登録する
+#
+# 環境変数:
+#   POPMAP_FIGURE_CACHE       応答をキャッシュするか（既定は 1）
+#   POPMAP_FIGURE_CACHE_MB    保持する応答の合計サイズの上限（MB、既定は 256）
+#   POPMAP_FIGURE_CACHE_GZIP  gzip圧縮した応答も保持し、対応しているクライアントにはそれを返すか（既定は 1）
+#   POPMAP_FIGURE_CACHE_WARM  起動時の事前読み込みの後に応答を作っておく範囲（wsgi.py 経由で起動した場合）
+#                             'maps' はすべての市×変数の地図、'all' はそれに加えて町ごとの棒グラフ。既定は作らない
+
+import gzip
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from data_loader import city_signature, city_components
+from serving import env_flag
+from callback_requests import UPDATE_COMPONENT_PATH, DEPENDENCIES_PATH, find_callback, build_payload
+
+ENABLED = env_flag('POPMAP_FIGURE_CACHE', True)
+MAX_BYTES = int(float(os.environ.get('POPMAP_FIGURE_CACHE_MB', '256')) * 1024 * 1024)
+COMPRESS = env_flag('POPMAP_FIGURE_CACHE_GZIP', True)
+WARM = os.environ.get('POPMAP_FIGURE_CACHE_WARM', '').lower()
+
+# この大きさ以上の応答だけgzip圧縮したものも保持する
+GZIP_MIN_BYTES = 1024
+
+# コールバックの出力（/_dash-dependencies の 'output'）→ キーを作る関数
+_key_functions = {}
+
+# キー → {'body': 応答本文, 'gzip': 圧縮した本文（または None）, 'size': 合計バイト数}
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'bytes': 0}
+
+def cacheable(output, key_function):
+    # output のコールバックの応答をキャッシュする
+    # key_function(values, changed) は入力・状態の値 {'city_selection.value': ..., ...} と変更された入力のリストから
+    # (市, 応答を決めるものの組) を返す。None を返したリクエストはキャッシュしない
+    _key_functions[output] = key_function
+
+def request_key(payload):
+    # /_dash-update-component のリクエスト本文からキャッシュのキーを作る（キャッシュしないリクエストは None）
+    key_function = _key_functions.get(payload.get('output'))
+    if key_function is None:
+        return None
+    try:
+        items = list(payload.get('inputs') or []) + list(payload.get('state') or [])
+        values = {f"{item['id']}.{item['property']}": item.get('value') for item in items}
+        result = key_function(values, list(payload.get('changedPropIds') or []))
+    except (KeyError, TypeError, AttributeError, IndexError):
+        return None
+    if result is None:
+        return None
+    city, parts = result
+    return (payload['output'], city, city_signature(city)) + tuple(parts)
+
+def lookup(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            _stats['misses'] += 1
+            return None
+        _entries.move_to_end(key)
+        _stats['hits'] += 1
+        return entry
+
+def store(key, body):
+    # 応答本文を保持する（圧縮はロックの外で行う）。1件で上限を超えるものは保持しない
+    compressed = gzip.compress(body, compresslevel=6) if COMPRESS and len(body) >= GZIP_MIN_BYTES else None
+    size = len(body) + (len(compressed) if compressed else 0)
+    if size > MAX_BYTES:
+        return
+    with _lock:
+        old = _entries.pop(key, None)
+        if old is not None:
+            _stats['bytes'] -= old['size']
+        _entries[key] = {'body': body, 'gzip': compressed, 'size': size}
+        _stats['bytes'] += size
+        _stats['stores'] += 1
+        while _stats['bytes'] > MAX_BYTES:
+            _, evicted = _entries.popitem(last=False)
+            _stats['bytes'] -= evicted['size']
+            _stats['evictions'] += 1
+
+def clear():
+    with _lock:
+        _entries.clear()
+        _stats['bytes'] = 0
+
+def cache_info():
+    with _lock:
+        return dict(_stats, entries=len(_entries), max_bytes=MAX_BYTES, enabled=ENABLED, compress=COMPRESS)
+
+def skip():
+    # このリクエストの応答をキャッシュしない（エラーで空のFigureを返すときなどにコールバック内から呼ぶ）
+    from flask import g, has_request_context
+    if has_request_context():
+        g.figure_cache_skip = True
+
+def register_figure_cache(server):
+    # Dashの土台のFlaskサーバーで、コールバックを呼ぶ前にキャッシュを引き、呼んだ後に応答を保持する
+    from flask import Response, g, request
+
+    @server.before_request
+    def figure_cache_lookup():
+        if not ENABLED or request.method != 'POST' or not request.path.endswith(UPDATE_COMPONENT_PATH):
+            return None
+        payload = request.get_json(silent=True)
+        key = request_key(payload) if isinstance(payload, dict) else None
+        if key is None:
+            return None
+        entry = lookup(key)
+        if entry is None:
+            g.figure_cache_key = key
+            return None
+        response = Response(entry['body'], mimetype='application/json')
+        if entry['gzip'] is not None and 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+            response.set_data(entry['gzip'])
+            response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    @server.after_request
+    def figure_cache_store(response):
+        key = g.pop('figure_cache_key', None)
+        if (key is not None and response.status_code == 200 and not g.get('figure_cache_skip')
+                and not response.is_streamed and 'Content-Encoding' not in response.headers):
+            store(key, response.get_data())
+        return response
+
+    return server
+
+def warm(server, cities, towns=False):
+    # 市×変数の地図（towns=True なら町ごとの棒グラフも）のリクエストを送り、応答をキャッシュに入れておく
+    # 地図はブラウザで市を選んだとき（ジオメトリを含む全体）と、変数を切り替えたとき（値だけの部分更新）の両方
+    from bands import build_variable_options
+    from age_profiles import age_profiles
+    from time_series import year_choices
+
+    if not ENABLED:
+        return 0
+    start = time.perf_counter()
+    client = server.test_client()
+    dependencies = client.get(DEPENDENCIES_PATH).get_json()
+    map_spec = find_callback(dependencies, 'mapPlot.figure')
+    bar_spec = find_callback(dependencies, 'barPlot.figure')
+    payloads = []
+    for city in cities:
+        components = city_components(city)
+        # 市を切り替えたときのスライダーの位置（最新）
+        year_index = len(year_choices(city)) - 1
+        for variable in build_variable_options().values():
+            values = {'city_selection.value': components, 'data_ready.data': {'city': city}, 'variable.value': variable,
+                      'year.value': year_index}
+            payloads.append(build_payload(map_spec, values, ['data_ready.data']))
+            payloads.append(build_payload(map_spec, dict(values, **{'map_state.data': {'city': city}}),
+                                          ['variable.value']))
+        if towns:
+            for town in age_profiles(city)['town_index']:
+                values = {'city_selection.value': components, 'data_ready.data': {'city': city},
+                          'mapPlot.clickData': {'points': [{'location': town}]}}
+                payloads.append(build_payload(bar_spec, values, ['mapPlot.clickData']))
+    for payload in payloads:
+        response = client.post(UPDATE_COMPONENT_PATH, json=payload)
+        if response.status_code not in (200, 204):
+            logging.warning("応答の事前作成に失敗しました: %s (HTTP %d)", payload['output'], response.status_code)
+    info = cache_info()
+    logging.info("Warmed %d responses in %.2fs (%d entries, %.1f MB)", len(payloads), time.perf_counter() - start,
+                 info['entries'], info['bytes'] / 1024 / 1024)
+    return len(payloads)
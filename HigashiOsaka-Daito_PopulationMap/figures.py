@@ -0,0 +1,132 @@
+# figures.py
+
+# 地図・グラフのFigureを組み立てる処理をまとめたファイル
+# 地図のジオメトリ（GeoJSON）はデータセットごとに一度だけ作成してキャッシュし、
+# 変数の切り替え時は色分けの値だけをブラウザに送る（Patchによる部分更新）
+
+import numpy as np  # 数値配列を扱うライブラリ
+import plotly.graph_objects as go  # 高度にカスタマイズ可能なグラフ作成用ツール
+from dash import Patch  # Figureの一部だけを更新するための仕組み
+from shapely.geometry import mapping  # shapelyのジオメトリをGeoJSON形式の辞書に変換する
+from data_loader import get_derived
+from simplification import level_for_zoom, simplified_geometries
+from views import city_view
+from age_profiles import AGE_LABELS, SEX_INDEX
+from bands import variable_values
+from time_series import year_values, year_value_range, year_choices
+
+def _map_rows(data):
+    # 地図に描画する（町名とジオメトリがそろった）行の行番号
+    return np.flatnonzero(data['town_name'].notna().to_numpy() & data.geometry.notna().to_numpy())
+
+def map_rows(city):
+    return get_derived(city, 'map_rows', _map_rows)
+
+def _build_map_geometry(data, rows, geoms):
+    # 町名をidにした最小限のGeoJSONと、その並び順に対応するデータの行番号を作成する
+    # 属性（人口の各列）はGeoJSONに含めず、色分けの値は z として別に送る
+    town_names = data['town_name'].iloc[rows].tolist()
+    features = [
+        {'type': 'Feature', 'id': name, 'properties': {}, 'geometry': mapping(geoms[row])}
+        for name, row in zip(town_names, rows)
+    ]
+    return {
+        'geojson': {'type': 'FeatureCollection', 'features': features},
+        'locations': town_names,
+        'rows': rows,
+    }
+
+def map_geometry(city, level=0):
+    # 指定した簡略化レベルの地図用ジオメトリ。データセット・レベルごとにキャッシュされる
+    return get_derived(city, f'map_geometry_{level}',
+                       lambda data: _build_map_geometry(data, map_rows(city), simplified_geometries(city)[level]))
+
+def map_values(city, selected_var, year=None):
+    # 地図の町の並び順にそろえた、選択された変数の値の配列（year を指定するとその年の年次データの値）
+    if year is None:
+        return variable_values(city, selected_var)[map_rows(city)]
+    return year_values(city, selected_var, year)[map_rows(city)]
+
+def _value_list(values):
+    # NaN は JSON の null として、整数値は小数点なしで送る
+    return [None if np.isnan(v) else int(v) if v.is_integer() else v for v in values.tolist()]
+
+def _value_range(values):
+    if np.isnan(values).all():
+        return None, None
+    return float(np.nanmin(values)), float(np.nanmax(values))
+
+def _map_value_range(city, selected_var, year, values):
+    # 年次データがある市では、年（「最新」を含む）を切り替えても色の基準が変わらないようにすべての年を通した範囲を使う
+    if year is None and len(year_choices(city)) <= 1:
+        return _value_range(values)
+    return year_value_range(city, selected_var)
+
+def _hovertemplate(display_label):
+    # %{location} は町名、%{z} は選択された変数の値（色分けに使用される変数）を表示
+    # <extra></extra> は追加の情報を表示しないために空の部分を指定
+    return "<b>%{location}</b><br>" + display_label + ": %{z}<extra></extra>"
+
+def build_map_figure(city, selected_var, display_label, year=None):
+    # ジオメトリを含む地図のFigure全体を（Figureの辞書として）作成する（市が切り替わったときに使用）
+    # 表示範囲（中心座標とズーム）はデータセットごとに計算済みのものを使う
+    view = city_view(city)
+    # 表示するズームで見分けられない細かさの頂点は送らない
+    geometry = map_geometry(city, level_for_zoom(view['zoom'], view['center']['lat']))
+    values = map_values(city, selected_var, year)
+    cmin, cmax = _map_value_range(city, selected_var, year, values)
+
+    fig = go.Figure(go.Choroplethmapbox(
+        locations=geometry['locations'],  # GeoJSONのidに対応する町名
+        z=_value_list(values),  # 色付けに使う変数の値
+        coloraxis='coloraxis',
+        marker_opacity=0.5,  # 地図上の色付けの透明度を指定
+        hovertemplate=_hovertemplate(display_label),
+    ))
+
+    fig.update_layout(
+        mapbox=dict(
+            style="open-street-map",  # 地図のスタイル（オープンストリートマップ）
+            zoom=view['zoom'],
+            center=view['center']
+        ),
+        coloraxis=dict(cmin=cmin, cmax=cmax, colorbar={'title': {'text': display_label}}),
+        # グラフが領域いっぱいに表示されるように右（r）、上（t）、左（l）、下（b）の余白をすべて0に設定
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+    )
+    # GeoJSONはplotlyの検証（全頂点のコピー）を通さず、辞書に変換した後でキャッシュ済みのものを差し込む
+    fig = fig.to_dict()
+    fig['data'][0]['geojson'] = geometry['geojson']  # 町名をidにしたGeoJSON
+    return fig
+
+def map_value_patch(city, selected_var, display_label, year=None):
+    # 表示中の地図の色分けの値・範囲・ホバー表示だけを差し替えるPatch（変数や年だけが切り替わったときに使用）
+    values = map_values(city, selected_var, year)
+    cmin, cmax = _map_value_range(city, selected_var, year, values)
+    patch = Patch()
+    patch['data'][0]['z'] = _value_list(values)
+    patch['data'][0]['hovertemplate'] = _hovertemplate(display_label)
+    patch['layout']['coloraxis']['cmin'] = cmin
+    patch['layout']['coloraxis']['cmax'] = cmax
+    patch['layout']['coloraxis']['colorbar']['title']['text'] = display_label
+    return patch
+
+def build_bar_figure(title_name, profile):
+    # 年齢層別人口の棒グラフ。profile は age_profiles の1行（年齢階級 × 性別の配列）
+    fig = go.Figure(go.Bar(
+        x=AGE_LABELS,
+        y=profile[:, SEX_INDEX['total']].tolist(),
+        hovertemplate="AgeGroup=%{x}<br>Population=%{y}<extra></extra>",
+    ))
+    # グラフの見た目を調整（タイトルの位置やフォント、軸のラベルなど）
+    fig.update_layout(
+        title={
+            'text': f'{title_name}の年齢層別人口',  # タイトルテキスト
+            'x': 0.503,  # タイトルの水平位置を調整
+            'xanchor': 'center',  # 中央揃え
+            'font': {'size': 14}  # タイトルフォントサイズ
+        },
+        xaxis_title='', # x軸のタイトルを非表示
+        yaxis_title='', # y軸のタイトルを非表示
+        xaxis_tickangle=45) # x軸ラベルを45度回転して表示
+    return fig
@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+
+# gunicorn -c gunicorn.conf.py wsgi:application で使う設定（環境変数で変更できる）
+#   POPMAP_HOST / POPMAP_PORT  待ち受けアドレス（既定 0.0.0.0:8050）
+#   POPMAP_WORKERS             ワーカープロセス数（既定はCPUコア数）
+#   POPMAP_THREADS             ワーカーあたりのスレッド数（既定 4）
+#   POPMAP_TIMEOUT             リクエストのタイムアウト秒数（既定 60）
+
+import os
+
+from serving import HOST, PORT, WORKERS, THREADS
+
+bind = f'{HOST}:{PORT}'
+workers = WORKERS
+threads = THREADS
+worker_class = 'gthread' if THREADS > 1 else 'sync'
+timeout = int(os.environ.get('POPMAP_TIMEOUT', '60'))
+# 親プロセスで wsgi.py を読み込み（データの事前読み込みを含む）、その後にワーカーを fork する。
+# 読み込んだデータはワーカー間でコピーオンライトで共有される
+preload_app = True
+accesslog = os.environ.get('POPMAP_ACCESS_LOG') or None
+loglevel = os.environ.get('POPMAP_LOG_LEVEL', 'info').lower()
@@ -0,0 +1,161 @@
+# instrumentation.py
+
+# 処理時間の計測（スパン）とカウンタ、Prometheus形式の /metrics エンドポイント
+# 環境変数 POPMAP_METRICS=1 のときだけ計測する。無効時の span() は何もしないコンテキストを返すだけなので、
+# 読み込みやコールバックの処理にほとんど負荷をかけない
+#
+# 計測するスパン: csv_read, shapefile_read, compiled_read, merge, crs_transform,
+#                 map_figure_build, map_patch_build, bar_aggregate, bar_figure_build, serialization
+
+import contextlib
+import os
+import threading
+import time
+from collections import defaultdict
+
+ENABLED = os.environ.get('POPMAP_METRICS', '').lower() in ('1', 'true', 'yes', 'on')
+
+# 処理時間のヒストグラムの区切り（秒）
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+# スパン名 → {'count', 'sum', 'max', 'buckets'}
+_spans = {}
+# (カウンタ名, ラベルの組) → 値
+_counters = defaultdict(int)
+_NULL_SPAN = contextlib.nullcontext()
+
+def observe(name, seconds):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+        stats['count'] += 1
+        stats['sum'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stats['buckets'][i] += 1
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start)
+        return False
+
+def span(name):
+    # with span('csv_read'): ... の形で処理時間を計測する（無効時は何もしない）
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+def increment(name, value=1, **labels):
+    # エラー件数などのカウンタを増やす（無効時も件数は数える。負荷はロックと加算のみ）
+    with _lock:
+        _counters[(name, tuple(sorted(labels.items())))] += value
+
+def snapshot():
+    with _lock:
+        spans = {name: dict(stats, buckets=list(stats['buckets'])) for name, stats in _spans.items()}
+        counters = dict(_counters)
+    return spans, counters
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+def render_prometheus():
+    # Prometheusのテキスト形式（version 0.0.4）で計測結果を出力する
+    from data_loader import cache_info
+    from figure_cache import cache_info as figure_cache_info
+    spans, counters = snapshot()
+    lines = [
+        '# HELP popmap_span_seconds Duration of instrumented hot-path steps.',
+        '# TYPE popmap_span_seconds histogram',
+    ]
+    for name, stats in sorted(spans.items()):
+        # buckets は「その区切り以下」の件数を数えているので、そのまま累積値になる
+        for bound, count in zip(BUCKETS, stats['buckets']):
+            lines.append(f'popmap_span_seconds_bucket{{span="{name}",le="{bound}"}} {count}')
+        lines.append(f'popmap_span_seconds_bucket{{span="{name}",le="+Inf"}} {stats["count"]}')
+        lines.append(f'popmap_span_seconds_sum{{span="{name}"}} {stats["sum"]:.6f}')
+        lines.append(f'popmap_span_seconds_count{{span="{name}"}} {stats["count"]}')
+
+    names = sorted({name for name, _ in counters})
+    for name in names:
+        lines.append(f'# TYPE popmap_{name} counter')
+        for (counter, labels), value in sorted(counters.items()):
+            if counter == name:
+                lines.append(f'popmap_{name}{_labels(labels)} {value}')
+
+    info = cache_info()
+    for key in ('hits', 'misses', 'evictions', 'invalidations'):
+        lines.append(f'# TYPE popmap_dataset_cache_{key}_total counter')
+        lines.append(f'popmap_dataset_cache_{key}_total {info[key]}')
+    lines.append('# TYPE popmap_dataset_cache_entries gauge')
+    lines.append(f'popmap_dataset_cache_entries {info["size"]}')
+    if info['memory']:
+        # 省メモリ表現（POPMAP_COMPACT=1）で変換したデータセットの変換前後のメモリ使用量
+        # 組み合わせビューの 'own' は、市区町村のデータと共有しているジオメトリを除いた分
+        lines.append('# TYPE popmap_dataset_memory_bytes gauge')
+        for key, stats in sorted(info['memory'].items()):
+            for stage in ('before', 'after', 'own'):
+                if stage not in stats:
+                    continue
+                lines.append(f'popmap_dataset_memory_bytes{{dataset="{key}",stage="{stage}"}} {stats[stage]}')
+    # 地図・棒グラフの応答キャッシュ（figure_cache.py）
+    figures = figure_cache_info()
+    for key in ('hits', 'misses', 'stores', 'evictions'):
+        lines.append(f'# TYPE popmap_figure_cache_{key}_total counter')
+        lines.append(f'popmap_figure_cache_{key}_total {figures[key]}')
+    lines.append('# TYPE popmap_figure_cache_entries gauge')
+    lines.append(f'popmap_figure_cache_entries {figures["entries"]}')
+    lines.append('# TYPE popmap_figure_cache_bytes gauge')
+    lines.append(f'popmap_figure_cache_bytes {figures["bytes"]}')
+    lines.append('# TYPE popmap_metrics_enabled gauge')
+    lines.append(f'popmap_metrics_enabled {int(ENABLED)}')
+    return '\n'.join(lines) + '\n'
+
+def _instrument_serialization():
+    # Dashがコールバックの戻り値をJSONに変換する処理の時間を serialization スパンとして計測する
+    try:
+        import dash._callback as dash_callback
+    except ImportError:
+        return
+    to_json = getattr(dash_callback, 'to_json', None)
+    if to_json is None or getattr(to_json, '_popmap_instrumented', False):
+        return
+
+    def timed_to_json(obj):
+        with span('serialization'):
+            return to_json(obj)
+
+    timed_to_json._popmap_instrumented = True
+    dash_callback.to_json = timed_to_json
+
+def register_metrics_endpoint(server, path='/metrics'):
+    # Dashの土台のFlaskサーバーに計測結果のエンドポイントを追加する
+    from flask import Response
+
+    if ENABLED:
+        _instrument_serialization()
+
+    @server.route(path)
+    def metrics():
+        return Response(render_prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    return server
@@ -3,70 +3,31 @@
 # dash.dcc ドロップダウンやグラフ描画などのコンポーネントが含まれる
 # dash.html HTMLの基本要素をPythonで記述できる
 from dash import dcc, html
+from bands import build_variable_options
+from data_loader import discover_municipalities
 
 # ドロップダウンメニューの選択肢を定義する辞書オブジェクト[キー(ラベル):値]
-variable_options = {
-    # 生徒候補
-    "男女20-39歳": "age_20_39",
-    "男女小4-中3_10-14歳": "age_10_14",
-    "男20-39歳": "male_age_20_39",
-    "女20-39歳": "female_age_20_39",
-    "男小4-中3_10-14歳": "male_age_10_14",
-    "女小4-中3_10-14歳": "female_age_10_14",
-    
-    # 総人口関連
-    "総人口": "population_total",
-    "男性": "male_total",
-    "女性": "female_total",
+# 生徒候補・総人口関連・年齢別・男性の年齢別・女性の年齢別の順に、bands.py の定義から生成する
+variable_options = build_variable_options()
 
-    # 年齢別
-    "10歳未満": "age_under_10",
-    "10-19歳": "age_10_19",
-    "20-29歳": "age_20_29",
-    "30-39歳": "age_30_39",
-    "40-49歳": "age_40_49",
-    "50-59歳": "age_50_59",
-    "60-69歳": "age_60_69",
-    "70-74歳": "age_70_74",
-    "75歳以上": "age_over_75",
-
-    # 男性の年齢別
-    "男性 10歳未満": "male_age_under_10",
-    "男性 10-19歳": "male_age_10_19",
-    "男性 20-29歳": "male_age_20_29",
-    "男性 30-39歳": "male_age_30_39",
-    "男性 40-49歳": "male_age_40_49",
-    "男性 50-59歳": "male_age_50_59",
-    "男性 60-69歳": "male_age_60_69",
-    "男性 70-74歳": "male_age_70_74",
-    "男性 75歳以上": "male_age_over_75",
-
-    # 女性の年齢別
-    "女性 10歳未満": "female_age_under_10",
-    "女性 10-19歳": "female_age_10_19",
-    "女性 20-29歳": "female_age_20_29",
-    "女性 30-39歳": "female_age_30_39",
-    "女性 40-49歳": "female_age_40_49",
-    "女性 50-59歳": "female_age_50_59",
-    "女性 60-69歳": "female_age_60_69",
-    "女性 70-74歳": "female_age_70_74",
-    "女性 75歳以上": "female_age_over_75"
-}
+# data/ 以下から見つかった市区町村 {市区町村名: 表示名}
+municipalities = discover_municipalities()
+# 最初に表示する市（東大阪市＆大東市。データがない場合は見つかったすべての市区町村）
+default_cities = [name for name in ('higashiosaka', 'daitou') if name in municipalities] or list(municipalities)
 
 # レイアウト構成
 # Dashアプリ全体のレイアウトを定義するトップレベルの<div>タグ
 layout = html.Div([
     # サブレイアウトを構成する<div>タグ。複数のUI要素を内包
     html.Div([
-        # 市選択ドロップダウン
+        # 市選択ドロップダウン（data/ 以下の市区町村から複数選択でき、選んだ市を結合して表示）
         dcc.Dropdown(
             id='city_selection',
             options=[
-                {'label': '東大阪市', 'value': 'higashiosaka'},
-                {'label': '大東市', 'value': 'daitou'},
-                {'label': '東大阪市＆大東市', 'value': 'higashiosaka_daitou'}
-            ],
-            value='higashiosaka_daitou',  # デフォルト値を設定
+                {'label': label, 'value': name}
+                  for name, label in municipalities.items()],
+            value=default_cities,  # デフォルト値を設定
+            multi=True,
             placeholder="▼選択してください",# 何も選択されていない場合表示
             style={'width': '90%'}# ドロップダウンの幅
         ),
@@ -89,6 +50,22 @@ layout = html.Div([
 
     # 地図表示部分
     html.Div([# 地図グラフを表示するための<div>タグ
+        dcc.Store(id='map_state'),# 地図に読み込まれている市を記録（変数の切り替え時に値だけを送るために使用）
+        dcc.Store(id='data_ready'),# データの準備ができた市を記録（地図・棒グラフはこの値が選択中の市になってから更新する）
+        dcc.Store(id='load_request'),# バックグラウンドで準備する市（データの準備に時間がかかる場合だけ設定される）
+        # データの準備中に表示する進み具合（バックグラウンドでの準備中のみ表示）
+        html.Div([
+            html.Span('データを準備しています…', id='load_message', style={'margin-right': '10px'}),
+            html.Progress(id='load_progress', value='0', max='1', style={'width': '200px'}),
+        ], id='load_status', style={'display': 'none'}),
+        # 年のスライダー（年次の人口データ <市区町村名>_population_<年>.csv がある場合だけ表示）
+        # 値は選択肢（time_series.year_choices）の番号。再生ボタンで一定間隔ごとに次の年へ進める
+        html.Div([
+            html.Button('▶ 再生', id='year_play', n_clicks=0, style={'margin-right': '10px'}),
+            html.Div(dcc.Slider(id='year', min=0, max=0, step=None, value=0, marks={0: '最新'}),
+                     style={'flex': '1'}),
+            dcc.Interval(id='year_timer', interval=1500, disabled=True),
+        ], id='year_control', style={'display': 'none'}),
         dcc.Graph(# Dashでグラフを表示するためのコンポーネント
             id='mapPlot', style={'height': '700px', 'width': '100%'})# グラフの高さ、幅を親要素に対して設定
     ], style={'width': '80%',# 親レイアウト全体の%の幅を割り当てる
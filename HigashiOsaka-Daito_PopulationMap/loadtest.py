@@ -0,0 +1,402 @@
+# loadtest.py
+
+# コールバックの負荷試験
+# 起動中のサーバーの /_dash-update-component に、ブラウザと同じ形・同じ順序のリクエストを複数の仮想ユーザーから同時に送り、
+# コールバックごとのスループット・レイテンシ（p50/p95/p99）・エラー率を計測する。
+# 仮想ユーザーは 市を選ぶ（check_data → 年のスライダー → 地図全体・棒グラフ）のあと、変数の切り替え（地図の部分更新）と
+# 町のクリック（棒グラフ）を、市の切り替えを時々はさみながら繰り返す。
+# 同時接続数を段階的に増やして計測すれば、p99 が悪化し始める同時接続数（1台で受けられる利用者数）の目安が分かる。
+# 市・町・変数の一覧はデータAPI（/api/cities 以下）から取得するので、サーバーと同じデータがなくても実行できる
+#
+# 使い方:
+#   python loadtest.py --users 1 4 16 --duration 30                    # http://127.0.0.1:8050 のサーバーを計測
+#   python loadtest.py --start --workers 4 --users 8 32 --output load.json  # サーバーを起動して計測し、結果を保存
+#   python loadtest.py --url http://host:8050 --city daitou --variable age_20_39 --think-time 0.5
+#
+# 仮想ユーザーはこのプロセスのスレッドで動かす。大きな同時接続数で計測する場合は、このプロセスのCPU使用率が
+# 飽和していないことを確認すること（飽和している場合は複数のマシン・プロセスから実行する）
+
+import argparse
+import gzip
+import http.client
+import importlib.util
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit, quote
+
+from callback_requests import UPDATE_COMPONENT_PATH, DEPENDENCIES_PATH, find_callback, build_payload, response_outputs
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 仮想ユーザーの操作の割合（市の切り替え・変数の切り替え・町のクリック）
+ACTION_WEIGHTS = {'city': 1, 'variable': 4, 'click': 5}
+
+# バックグラウンドでのデータの準備の結果を確認する間隔（秒、ブラウザと同じ）
+BACKGROUND_POLL_SECONDS = 1.0
+
+# 表に出力するコールバックの並び順
+CALLBACK_ORDER = ['check_data', 'update_year_control', 'prepare_data', 'update_map.full', 'update_map.patch',
+                  'update_bar.city', 'update_bar.click']
+
+class _Connection:
+    # 仮想ユーザーごとのHTTP接続（ブラウザと同じく keep-alive で使い回す）
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host, self.port = parts.hostname, parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.connection = None
+        self.reused = False
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.reused = False
+
+    def request(self, method, path, payload=None):
+        # (ステータス, 展開済みの応答本文, 受信したバイト数) を返す
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Accept-Encoding': 'gzip', 'Accept': 'application/json'}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        while True:
+            if self.connection is None:
+                self.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+            reused = self.reused
+            try:
+                self.connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                self.close()
+                # サーバーが待機中の keep-alive 接続を閉じていた場合だけ、接続し直して送り直す
+                if reused:
+                    continue
+                raise
+            self.reused = True
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+            size = len(data)
+            if response.getheader('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            return response.status, data, size
+
+    def get_json(self, path):
+        status, data, _ = self.request('GET', path)
+        if status != 200:
+            raise RuntimeError(f"GET {path}: HTTP {status}")
+        return json.loads(data)
+
+# ---- 計測対象の準備 ----
+
+def _background_spec(dependencies, output):
+    # バックグラウンドコールバックの出力は 'data_ready.data@<ハッシュ>' の形になる（allow_duplicate）
+    for spec in dependencies:
+        if spec['output'].split('@')[0] == output:
+            return spec
+    return None
+
+def discover_targets(url, timeout, cities=None, variables=None):
+    # コールバックの定義と、データAPIから市・町・変数の一覧を取得する
+    connection = _Connection(url, timeout)
+    dependencies = connection.get_json(DEPENDENCIES_PATH)
+    specs = {
+        'check_data': find_callback(dependencies, 'load_request.data'),
+        'update_year_control': find_callback(dependencies, 'year.marks'),
+        'prepare_data': _background_spec(dependencies, 'data_ready.data'),
+        'update_map': find_callback(dependencies, 'mapPlot.figure'),
+        'update_bar': find_callback(dependencies, 'barPlot.figure'),
+    }
+    if not cities:
+        names = [city['name'] for city in connection.get_json('/api/cities')['cities']]
+        # 各市区町村と、すべての市区町村を結合したビュー（画面の既定の表示）
+        cities = names + (['+'.join(names)] if len(names) > 1 else [])
+    targets = []
+    for city in cities:
+        towns, offset = [], 0
+        while offset is not None:
+            page = connection.get_json(f"/api/cities/{quote(city)}/towns?offset={offset}&limit=1000"
+                                       f"&variables=population_total")
+            towns.extend(town['town_name'] for town in page['towns'])
+            offset = page['next_offset']
+        names = variables or [v['name'] for v in connection.get_json(f"/api/cities/{quote(city)}/variables")['variables']]
+        targets.append({'city': city, 'components': city.split('+'), 'towns': towns, 'variables': names})
+    connection.close()
+    return specs, targets
+
+# ---- 仮想ユーザー ----
+
+class _User:
+    # 1人の利用者の操作を、ブラウザが送るのと同じ順序のリクエストで再現する
+    def __init__(self, url, timeout, specs, targets, rng, records):
+        self.connection = _Connection(url, timeout)
+        self.specs = specs
+        self.targets = targets
+        self.rng = rng
+        self.records = records
+        self.target = None
+        self.values = {}
+
+    def call(self, name, spec, changed, query='', parse=False):
+        # コールバックを1回呼び出して記録する。parse=True なら応答の出力 {'id.property': 値} を返す（エラー時は None）
+        payload = build_payload(spec, self.values, changed)
+        start = time.perf_counter()
+        try:
+            status, data, size = self.connection.request('POST', UPDATE_COMPONENT_PATH + query, payload)
+        except (http.client.HTTPException, OSError) as e:
+            self.records.append((name, start, time.perf_counter() - start, 0, type(e).__name__))
+            return None
+        self.records.append((name, start, time.perf_counter() - start, size,
+                             None if status in (200, 204) else f"HTTP {status}"))
+        if status == 204:
+            return {}
+        if status != 200 or not parse:
+            return {} if status == 200 else None
+        return json.loads(data)
+
+    def prepare_in_background(self, load_request):
+        # バックグラウンドでのデータの準備（ジョブを開始し、結果が出るまで一定間隔で確認する）。準備が終わるまでの時間を記録する
+        spec = self.specs['prepare_data']
+        self.values['load_request.data'] = load_request
+        start = time.perf_counter()
+        job = self.call('prepare_data.start', spec, ['load_request.data'], parse=True)
+        while job and 'cacheKey' in job:
+            time.sleep(BACKGROUND_POLL_SECONDS)
+            body = self.call('prepare_data.poll', spec, ['load_request.data'],
+                             query=f"?cacheKey={job['cacheKey']}&job={job['job']}", parse=True)
+            if not body:  # エラー、またはジョブが取り消された（204）
+                break
+            if 'response' in body:
+                self.records.append(('prepare_data', start, time.perf_counter() - start, 0, None))
+                return response_outputs(body).get('data_ready.data')
+        self.records.append(('prepare_data', start, time.perf_counter() - start, 0, 'job failed'))
+        return None
+
+    def select_city(self):
+        # 市を選んだときにブラウザが送るリクエスト: check_data と年のスライダー → 地図全体・棒グラフ
+        self.target = self.rng.choice(self.targets)
+        self.values['city_selection.value'] = self.target['components']
+        self.values.setdefault('variable.value', self.rng.choice(self.target['variables']))
+        body = self.call('check_data', self.specs['check_data'], ['city_selection.value'], parse=True)
+        years = self.call('update_year_control', self.specs['update_year_control'], ['city_selection.value'], parse=True)
+        self.values['year.value'] = response_outputs(years or {}).get('year.value', 0)
+        outputs = response_outputs(body or {})
+        if 'load_request.data' in outputs and self.specs['prepare_data'] is not None:
+            ready = self.prepare_in_background(outputs['load_request.data'])
+        else:
+            ready = outputs.get('data_ready.data')
+        if not ready:
+            return
+        self.values['data_ready.data'] = ready
+        if self.call('update_map.full', self.specs['update_map'], ['data_ready.data', 'year.value']) is not None:
+            self.values['map_state.data'] = {'city': ready['city']}
+        self.call('update_bar.city', self.specs['update_bar'], ['data_ready.data'])
+
+    def switch_variable(self):
+        # 変数を切り替えたとき（同じ市の地図が表示されていれば値だけの部分更新）
+        self.values['variable.value'] = self.rng.choice(self.target['variables'])
+        self.call('update_map.patch', self.specs['update_map'], ['variable.value'])
+
+    def click_town(self):
+        # 地図上の町をクリックしたとき
+        index = self.rng.randrange(len(self.target['towns']))
+        self.values['mapPlot.clickData'] = {'points': [
+            {'curveNumber': 0, 'pointNumber': index, 'pointIndex': index, 'location': self.target['towns'][index]}]}
+        self.call('update_bar.click', self.specs['update_bar'], ['mapPlot.clickData'])
+
+    def run(self, deadline, think_time):
+        self.select_city()
+        actions = list(ACTION_WEIGHTS)
+        weights = list(ACTION_WEIGHTS.values())
+        while time.perf_counter() < deadline:
+            if think_time > 0:
+                time.sleep(self.rng.expovariate(1 / think_time))
+            action = self.rng.choices(actions, weights)[0]
+            if action == 'city' or 'data_ready.data' not in self.values:
+                self.select_city()
+            elif action == 'variable':
+                self.switch_variable()
+            elif self.target['towns']:
+                self.click_town()
+        self.connection.close()
+
+# ---- 実行・集計 ----
+
+def _percentile(sorted_values, p):
+    # 最近傍順位法によるパーセンタイル
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+def summarize(records, seconds):
+    # 記録 (コールバック, 開始時刻, 所要時間, 受信バイト数, エラー) をコールバックごとに集計する
+    groups = {}
+    for record in records:
+        groups.setdefault(record[0], []).append(record)
+    groups['total'] = [record for record in records if record[0] != 'prepare_data']
+    summary = {}
+    for name, items in groups.items():
+        times = sorted(elapsed * 1000 for _, _, elapsed, _, error in items if error is None)
+        errors = [error for *_, error in items if error is not None]
+        summary[name] = {
+            'requests': len(items),
+            'errors': len(errors),
+            'error_rate': round(len(errors) / len(items), 4) if items else 0.0,
+            'throughput_rps': round(len(items) / seconds, 2) if seconds > 0 else None,
+            'p50_ms': _round(_percentile(times, 50)),
+            'p95_ms': _round(_percentile(times, 95)),
+            'p99_ms': _round(_percentile(times, 99)),
+            'mean_ms': _round(sum(times) / len(times) if times else None),
+            'max_ms': _round(times[-1] if times else None),
+            'bytes_mean': round(sum(size for _, _, _, size, _ in items) / len(items)) if items else 0,
+            'error_types': {error: errors.count(error) for error in sorted(set(errors))},
+        }
+    return summary
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+def run_stage(url, timeout, specs, targets, users, duration, warmup, think_time, seed):
+    # users 人の仮想ユーザーを duration 秒動かす。最初の warmup 秒の記録は集計しない
+    records = [[] for _ in range(users)]
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+    threads = []
+    for i in range(users):
+        user = _User(url, timeout, specs, targets, random.Random(f"{seed}-{users}-{i}"), records[i])
+        thread = threading.Thread(target=user.run, args=(deadline, think_time), daemon=True)
+        thread.start()
+        # 全員が同時に市を選ばないように、開始を少しずつずらす
+        time.sleep(min(0.05, warmup / max(users, 1)))
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    end = time.perf_counter()
+    measured = [record for user_records in records for record in user_records if record[1] >= measure_from]
+    seconds = min(end, deadline) - measure_from
+    return {'users': users, 'seconds': round(seconds, 2), 'callbacks': summarize(measured, seconds)}
+
+def print_stage(stage):
+    print(f"\nusers={stage['users']} ({stage['seconds']}s)")
+    print(f"{'callback':<20} {'requests':>9} {'rps':>8} {'errors':>7} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9} {'bytes':>9}")
+    callbacks = stage['callbacks']
+    names = [name for name in CALLBACK_ORDER if name in callbacks]
+    names += sorted(name for name in callbacks if name not in names and name != 'total') + ['total']
+    for name in names:
+        stats = callbacks[name]
+        def fmt(value):
+            return f"{value:9.1f}" if value is not None else f"{'-':>9}"
+        print(f"{name:<20} {stats['requests']:>9} {stats['throughput_rps'] or 0:8.1f} {stats['error_rate']:7.1%} "
+              f"{fmt(stats['p50_ms'])} {fmt(stats['p95_ms'])} {fmt(stats['p99_ms'])} {stats['bytes_mean']:>9}")
+
+# ---- サーバーの起動 ----
+
+def _wait_ready(url, timeout, proc):
+    # /readyz が200を返すまで待つ（データの事前読み込みが終わるまで）
+    connection = _Connection(url, 5)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"サーバーが終了しました（終了コード {proc.returncode}）。")
+        try:
+            status, _, _ = connection.request('GET', '/readyz')
+            if status == 200:
+                return
+        except (http.client.HTTPException, OSError):
+            connection.close()
+        time.sleep(0.5)
+    raise RuntimeError(f"{timeout}秒以内にサーバーの準備ができませんでした。")
+
+def start_server(port, workers, threads, log_file, timeout):
+    # gunicorn（Windows や未インストールの場合は wsgi.py）でサーバーを起動し、準備ができるまで待つ
+    if os.name != 'nt' and importlib.util.find_spec('gunicorn') is not None:
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application']
+    else:
+        command = [sys.executable, 'wsgi.py']
+    env = dict(os.environ, POPMAP_HOST='127.0.0.1', POPMAP_PORT=str(port))
+    if workers:
+        env['POPMAP_WORKERS'] = str(workers)
+    if threads:
+        env['POPMAP_THREADS'] = str(threads)
+    output = open(log_file, 'ab') if log_file else subprocess.DEVNULL
+    proc = subprocess.Popen(command, cwd=BASE_DIR, env=env, stdout=output, stderr=subprocess.STDOUT)
+    try:
+        _wait_ready(f"http://127.0.0.1:{port}", timeout, proc)
+    except Exception:
+        stop_server(proc)
+        raise
+    return proc
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="コールバックのエンドポイントに同時にリクエストを送り、処理能力を計測する")
+    parser.add_argument('--url', default='http://127.0.0.1:8050', help="計測するサーバーのURL（--start の場合は無視）")
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 4, 16],
+                        help="同時に操作する仮想ユーザー数（複数指定すると順に計測する）")
+    parser.add_argument('--duration', type=float, default=30, help="各段階の計測時間（秒）")
+    parser.add_argument('--warmup', type=float, default=5, help="各段階の最初の集計しない時間（秒）")
+    parser.add_argument('--think-time', type=float, default=0,
+                        help="仮想ユーザーの操作の間隔の平均（秒）。0 なら間をあけずに操作する")
+    parser.add_argument('--city', action='append', dest='cities',
+                        help="操作する市（'+' 区切りで組み合わせ。複数指定可）。省略時は各市区町村とすべてを結合したビュー")
+    parser.add_argument('--variable', action='append', dest='variables', help="切り替える変数（複数指定可）。省略時はすべての変数")
+    parser.add_argument('--seed', default='popmap', help="操作の乱数の種（同じ値なら同じ操作の列になる）")
+    parser.add_argument('--timeout', type=float, default=60, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument('--start', action='store_true', help="サーバーを起動して計測し、終了後に停止する")
+    parser.add_argument('--port', type=int, default=8765, help="--start で起動するサーバーのポート番号")
+    parser.add_argument('--workers', type=int, help="--start で起動するサーバーのワーカー数（POPMAP_WORKERS）")
+    parser.add_argument('--threads', type=int, help="--start で起動するサーバーのワーカーあたりのスレッド数（POPMAP_THREADS）")
+    parser.add_argument('--server-log', help="--start で起動したサーバーのログを書き出すファイル")
+    parser.add_argument('--start-timeout', type=float, default=300, help="--start でサーバーの準備を待つ時間（秒）")
+    parser.add_argument('--output', help="結果のJSONを書き出すファイル")
+    args = parser.parse_args(argv)
+
+    proc = None
+    url = args.url.rstrip('/')
+    if args.start:
+        url = f"http://127.0.0.1:{args.port}"
+        print(f"Starting server on {url} ...", file=sys.stderr)
+        proc = start_server(args.port, args.workers, args.threads, args.server_log, args.start_timeout)
+    try:
+        specs, targets = discover_targets(url, args.timeout, args.cities, args.variables)
+        stages = []
+        for users in args.users:
+            stage = run_stage(url, args.timeout, specs, targets, users, args.duration, args.warmup,
+                              args.think_time, args.seed)
+            print_stage(stage)
+            stages.append(stage)
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'url': url,
+        'settings': {'duration': args.duration, 'warmup': args.warmup, 'think_time': args.think_time,
+                     'seed': args.seed, 'workers': args.workers, 'threads': args.threads,
+                     'cities': [target['city'] for target in targets], 'action_weights': ACTION_WEIGHTS},
+        'stages': stages,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if any(stage['callbacks'].get('total', {}).get('errors') for stage in stages) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
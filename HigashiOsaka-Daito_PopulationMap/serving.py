@@ -0,0 +1,121 @@
+# serving.py
+
+# 本番（複数ワーカー）での配信に使う処理
+# ワーカーを fork する前に親プロセスで全データセットと派生データ（簡略化した境界・表示範囲・年齢構成・年齢層の集計・空間インデックス・年次データ）を
+# 作成しておき、各ワーカーはそれをコピーオンライトで共有する。ワーカーごとの読み込み時間とメモリを払わずに済む
+#
+# 環境変数:
+#   POPMAP_PRELOAD  起動時にデータを事前読み込みするか（wsgi.py の既定は 1）
+#   POPMAP_HOST / POPMAP_PORT / POPMAP_WORKERS / POPMAP_THREADS  待ち受けアドレスとワーカー数（gunicorn.conf.py で使用）
+#   POPMAP_COMPACT  使う列だけを小さい型で保持する省メモリ表現（ワーカーあたりの常駐メモリを減らす。data_loader.py）
+#   POPMAP_FIGURE_CACHE_WARM  事前読み込みの後に地図・棒グラフの応答を作っておく範囲（figure_cache.py）
+#   POPMAP_BACKGROUND  時間のかかるデータの準備をバックグラウンドのジョブで行うか（既定は 1。diskcache が必要）
+#   POPMAP_JOB_CACHE_DIR  バックグラウンドのジョブの状態・結果を置くディレクトリ（既定は一時ディレクトリ内の popmap-jobs）
+
+import gc
+import logging
+import os
+import tempfile
+import time
+
+import data_loader
+from data_loader import warm_cache, discover_municipalities, normalize_city, cache_info
+
+HOST = os.environ.get('POPMAP_HOST', '0.0.0.0')
+PORT = int(os.environ.get('POPMAP_PORT', '8050'))
+WORKERS = int(os.environ.get('POPMAP_WORKERS', '0')) or (os.cpu_count() or 1)
+THREADS = int(os.environ.get('POPMAP_THREADS', '4'))
+JOB_CACHE_DIR = os.environ.get('POPMAP_JOB_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'popmap-jobs')
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+# 準備状態（/readyz で返す）。事前読み込みをしない場合は最初のリクエストで読み込むので、起動直後から ready とする
+_state = {'ready': True, 'preloaded': [], 'preload_seconds': None, 'error': None}
+
+def preload_cities():
+    # 事前読み込みするビュー: data/ 以下の各市区町村、すべての市区町村を結合したビュー（画面の既定の表示）
+    names = list(discover_municipalities())
+    cities = list(names)
+    if len(names) > 1:
+        cities.append(normalize_city(names))
+    return cities
+
+def preload_data(cities=None):
+    # データセットと、コールバックで使う派生データをすべて作成しておく
+    from figures import build_map_figure
+    from age_profiles import age_profiles
+    from bands import variable_values
+    from layout import variable_options
+    from spatial_index import spatial_index
+    from time_series import year_cube
+
+    _state['ready'] = False
+    start = time.perf_counter()
+    cities = cities or preload_cities()
+    # 事前読み込みしたデータが追い出されないように、キャッシュの上限を読み込むビューの数以上にする
+    data_loader.CACHE_MAX_ENTRIES = max(data_loader.CACHE_MAX_ENTRIES, len(cities))
+    try:
+        warm_cache(cities)
+        for city in cities:
+            age_profiles(city)
+            spatial_index(city)
+            year_cube(city)
+            for variable in variable_options.values():
+                variable_values(city, variable)
+            build_map_figure(city, 'age_20_39', '')
+    except Exception as e:
+        _state['error'] = str(e)
+        logging.error("データの事前読み込みに失敗しました: %s", e)
+        raise
+    _state.update(ready=True, preloaded=cities, preload_seconds=round(time.perf_counter() - start, 3), error=None)
+    logging.info("Preloaded %d datasets in %.2fs", len(cities), _state['preload_seconds'])
+    return cities
+
+def freeze_shared_memory():
+    # 読み込み済みのオブジェクトをGCの対象外（永続世代）に移す。
+    # ワーカーでGCが走ってもこれらのオブジェクトに書き込まないので、共有しているメモリページがコピーされない
+    gc.collect()
+    gc.freeze()
+
+def background_manager():
+    # バックグラウンドコールバックのジョブ管理（ローカルのディスクキャッシュとプロセスで実行し、外部のブローカーは使わない）
+    # ワーカーが複数でも同じディレクトリを使うので、どのワーカーに来たリクエストからでもジョブの進み具合を返せる
+    # diskcache（と multiprocess・psutil）がない場合や POPMAP_BACKGROUND=0 の場合は None（データの準備はリクエスト内で行う）
+    if not env_flag('POPMAP_BACKGROUND', True):
+        return None
+    try:
+        import diskcache
+        from dash import DiskcacheManager
+        return DiskcacheManager(diskcache.Cache(JOB_CACHE_DIR))
+    except ImportError as e:
+        logging.info("バックグラウンドコールバックを使えないため、データの準備はリクエスト内で行います（%s）。", e)
+        return None
+
+def register_health_endpoints(server):
+    # /healthz: プロセスが応答できるか（常に200）
+    # /readyz: データの準備ができているか（準備中・失敗時は503）。ロードバランサーの振り分け判定に使う
+    from flask import jsonify
+
+    @server.route('/healthz')
+    def healthz():
+        return jsonify(status='ok', pid=os.getpid())
+
+    @server.route('/readyz')
+    def readyz():
+        info = cache_info()
+        ready = _state['ready'] and bool(discover_municipalities())
+        body = {
+            'status': 'ready' if ready else 'not_ready',
+            'pid': os.getpid(),
+            'preloaded': _state['preloaded'],
+            'preload_seconds': _state['preload_seconds'],
+            'cached': info['keys'],
+            'error': _state['error'],
+        }
+        return jsonify(body), 200 if ready else 503
+
+    return server
@@ -0,0 +1,91 @@
+# simplification.py
+
+# 地図描画用ジオメトリの多段階簡略化
+# 町の境界を平面直角座標系（メートル単位）で複数の許容誤差で簡略化しておき、
+# 表示するズームに応じて適切なレベルのジオメトリをブラウザに送る。
+# 隣り合う町の共有境界は coverage_simplify でまとめて簡略化するので、簡略化後も隙間や重なりができない
+#
+# 使い方（レベルごとの頂点数とGeoJSONのバイト数を表示）:
+#   python simplification.py daitou+higashiosaka daitou
+
+import json
+import logging
+import math
+import sys
+
+import numpy as np  # 数値配列を扱うライブラリ
+import shapely  # ジオメトリ操作ライブラリ
+from shapely.geometry import mapping  # shapelyのジオメトリをGeoJSON形式の辞書に変換する
+import geopandas as gpd
+from data_loader import get_derived, PROJECTED_CRS
+from views import TILE_SIZE
+
+# 簡略化レベル → 許容誤差（メートル）。レベル0は簡略化しない元の解像度
+SIMPLIFY_TOLERANCES = {0: 0.0, 1: 1.0, 2: 2.5, 3: 5.0, 4: 10.0}
+
+# 表示ズームから何段階（1段階で2倍）拡大されても形が崩れないようにするか。
+# 地図は拡大・縮小のたびに送り直さないため、初期表示より1段階細かいズームに合わせたレベルを選ぶ
+ZOOM_HEADROOM = 1
+
+# GeoJSONに書き出す座標の小数点以下の桁数（1e-6度 ≒ 0.1m）
+COORDINATE_DECIMALS = 6
+
+def meters_per_pixel(zoom, lat):
+    # Webメルカトル（地図のタイルサイズ TILE_SIZE）での1ピクセルあたりの地上距離
+    return 40075016.686 * math.cos(math.radians(lat)) / (TILE_SIZE * 2 ** zoom)
+
+def level_for_zoom(zoom, lat):
+    # 拡大の余裕（ZOOM_HEADROOM）を見込んだズームで、半ピクセル以内の誤差に収まる最も粗いレベルを選ぶ
+    max_tolerance = meters_per_pixel(zoom + ZOOM_HEADROOM, lat) / 2
+    candidates = [level for level, tolerance in SIMPLIFY_TOLERANCES.items() if tolerance <= max_tolerance]
+    return max(candidates)
+
+def _simplify_coverage(geoms, tolerance):
+    if tolerance == 0:
+        return geoms
+    if shapely.coverage_is_valid(geoms):
+        return shapely.coverage_simplify(geoms, tolerance)
+    # 境界が重なっているなど、町のポリゴンが隙間のない敷き詰めになっていない場合は個別に簡略化する
+    logging.warning("Geometries do not form a valid coverage. Simplifying polygons individually.")
+    return shapely.simplify(geoms, tolerance, preserve_topology=True)
+
+def _round_coordinates(geoms):
+    return shapely.transform(geoms, lambda coords: np.round(coords, COORDINATE_DECIMALS))
+
+def _build_simplified_geometries(data):
+    # 全レベルの簡略化ジオメトリ（EPSG:4326、データと同じ行順）を一度に作成する
+    valid = data.geometry.notna().to_numpy()
+    projected = data.geometry[valid].to_crs(PROJECTED_CRS).values.to_numpy()
+    levels = {}
+    for level, tolerance in SIMPLIFY_TOLERANCES.items():
+        geoms = np.full(len(data), None, dtype=object)
+        simplified = gpd.GeoSeries(_simplify_coverage(projected, tolerance), crs=PROJECTED_CRS).to_crs(epsg=4326)
+        geoms[valid] = _round_coordinates(simplified.values.to_numpy())
+        levels[level] = geoms
+    return levels
+
+def simplified_geometries(city):
+    # レベル → 簡略化済みジオメトリの配列（データの行順）。データセットごとにキャッシュされる
+    return get_derived(city, 'simplified_geometries', _build_simplified_geometries)
+
+def simplification_report(city):
+    # レベルごとの許容誤差・頂点数・GeoJSONのバイト数（地図の調整用）
+    report = []
+    for level, geoms in simplified_geometries(city).items():
+        geoms = [geom for geom in geoms if geom is not None]
+        geojson = {'type': 'FeatureCollection',
+                   'features': [{'type': 'Feature', 'geometry': mapping(geom)} for geom in geoms]}
+        report.append({
+            'level': level,
+            'tolerance_m': SIMPLIFY_TOLERANCES[level],
+            'vertices': int(shapely.get_num_coordinates(np.asarray(geoms, dtype=object)).sum()),
+            'geojson_bytes': len(json.dumps(geojson, separators=(',', ':'))),
+        })
+    return report
+
+if __name__ == '__main__':
+    for city in sys.argv[1:] or ['daitou+higashiosaka']:
+        print(city)
+        print(f"{'level':>5} {'tol(m)':>7} {'vertices':>9} {'bytes':>10}")
+        for row in simplification_report(city):
+            print(f"{row['level']:>5} {row['tolerance_m']:>7} {row['vertices']:>9} {row['geojson_bytes']:>10}")
@@ -0,0 +1,123 @@
+# spatial_index.py
+
+# 町の境界の空間インデックス（STRtree）
+# データセットごとに一度だけ作成してキャッシュし、「この緯度経度を含む町」「この範囲に掛かる町」
+# 「最も近い町」をポリゴンを総当たりせずに求める。位置情報や住所から町を引く処理や、
+# 表示範囲内の町だけを送る処理に使う
+#
+# エンドポイント:
+#   /api/town-at?city=daitou+higashiosaka&lat=34.71&lon=135.62   （&max_distance=500 で最も近い町を探す距離をメートルで指定）
+#   /api/towns-in-bbox?city=daitou&bbox=135.60,34.69,135.65,34.73   （西端の経度,南端の緯度,東端の経度,北端の緯度）
+
+import math
+import os
+
+import numpy as np  # 数値配列を扱うライブラリ
+import shapely  # ジオメトリ操作ライブラリ
+from data_loader import get_derived, resolve_city, PROJECTED_CRS
+
+# /api/town-at で、どの町にも含まれない地点の最も近い町を探す距離の上限（メートル）
+# 環境変数 POPMAP_NEAREST_MAX_M で変更できる。これより遠い地点には最も近い町を返さない（nearest が null）
+NEAREST_MAX_DISTANCE = float(os.environ.get('POPMAP_NEAREST_MAX_M', '3000'))
+
+_transformer = None
+
+def _to_projected(lon, lat):
+    global _transformer
+    if _transformer is None:
+        from pyproj import Transformer
+        _transformer = Transformer.from_crs('EPSG:4326', PROJECTED_CRS, always_xy=True)
+    return _transformer.transform(lon, lat)
+
+def _build_spatial_index(data):
+    # 町名とジオメトリがそろった行のポリゴンで、緯度経度（EPSG:4326）と投影座標系の2つのツリーを作成する
+    rows = np.flatnonzero(data['town_name'].notna().to_numpy() & data.geometry.notna().to_numpy())
+    geometry = data.geometry.iloc[rows]
+    return {
+        'rows': rows,
+        'names': data['town_name'].iloc[rows].tolist(),
+        'tree': shapely.STRtree(geometry.to_numpy()),
+        'projected_tree': shapely.STRtree(geometry.to_crs(PROJECTED_CRS).to_numpy()),
+    }
+
+def spatial_index(city):
+    # {'rows': データの行番号, 'names': 町名, 'tree', 'projected_tree'}。データセットごとにキャッシュされる
+    return get_derived(city, 'spatial_index', _build_spatial_index)
+
+def town_at(city, lat, lon):
+    # 緯度経度の地点を含む町名（どの町にも含まれない場合は None）
+    # 境界線上の地点など複数の町に含まれる場合は、データの行順で最初の町を返す
+    index = spatial_index(city)
+    hits = index['tree'].query(shapely.Point(lon, lat), predicate='intersects')
+    if len(hits) == 0:
+        return None
+    return index['names'][int(hits.min())]
+
+def _bbox_hits(index, min_lon, min_lat, max_lon, max_lat):
+    return np.sort(index['tree'].query(shapely.box(min_lon, min_lat, max_lon, max_lat), predicate='intersects'))
+
+def rows_in_bbox(city, min_lon, min_lat, max_lon, max_lat):
+    # 範囲に掛かる町のデータの行番号（行順）
+    index = spatial_index(city)
+    return index['rows'][_bbox_hits(index, min_lon, min_lat, max_lon, max_lat)]
+
+def towns_in_bbox(city, min_lon, min_lat, max_lon, max_lat):
+    # 範囲に掛かる町名のリスト（行順）
+    index = spatial_index(city)
+    return [index['names'][i] for i in _bbox_hits(index, min_lon, min_lat, max_lon, max_lat)]
+
+def nearest_town(city, lat, lon, max_distance=None):
+    # 緯度経度の地点に最も近い町名と距離（メートル）。地点を含む町があれば距離は0
+    # max_distance（メートル）より近い町がない場合は (None, None) を返す
+    index = spatial_index(city)
+    point = shapely.Point(*_to_projected(lon, lat))
+    hits, distances = index['projected_tree'].query_nearest(point, max_distance=max_distance, return_distance=True)
+    if len(hits) == 0:
+        return None, None
+    # 同じ距離の町が複数ある場合は行順で最初の町
+    best = int(hits.min())
+    return index['names'][best], float(distances.min())
+
+def _request_city(args):
+    # ?city=daitou+higashiosaka または ?city=daitou&city=higashiosaka の形で指定された市区町村
+    # （クエリ文字列の + は空白として渡されるため、空白・+・カンマのいずれでも区切れる）
+    return resolve_city(args.getlist('city'))
+
+def register_spatial_endpoints(server):
+    # Dashの土台のFlaskサーバーに、緯度経度・範囲から町を引くエンドポイントを追加する
+    from flask import jsonify, request
+
+    @server.route('/api/town-at')
+    def api_town_at():
+        city = _request_city(request.args)
+        lat = request.args.get('lat', type=float)
+        lon = request.args.get('lon', type=float)
+        # 探す距離は指定があってもサーバーの上限までにする
+        max_distance = min(request.args.get('max_distance', NEAREST_MAX_DISTANCE, type=float), NEAREST_MAX_DISTANCE)
+        if city is None:
+            return jsonify(error='unknown city'), 404
+        if lat is None or lon is None or not (math.isfinite(lat) and math.isfinite(lon)):
+            return jsonify(error='lat and lon are required'), 400
+        if not max_distance >= 0:
+            return jsonify(error='max_distance must not be negative'), 400
+        town = town_at(city, lat, lon)
+        body = {'city': city, 'lat': lat, 'lon': lon, 'town': town}
+        if town is None:
+            # どの町にも含まれない地点は、max_distance 以内で最も近い町とその距離も返す（なければ null）
+            nearest, distance = nearest_town(city, lat, lon, max_distance=max_distance)
+            body['nearest'] = {'town': nearest, 'distance_m': round(distance, 1)} if nearest is not None else None
+        return jsonify(body)
+
+    @server.route('/api/towns-in-bbox')
+    def api_towns_in_bbox():
+        city = _request_city(request.args)
+        if city is None:
+            return jsonify(error='unknown city'), 404
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(v) for v in request.args.get('bbox', '').split(','))
+        except ValueError:
+            return jsonify(error='bbox must be min_lon,min_lat,max_lon,max_lat'), 400
+        towns = towns_in_bbox(city, min_lon, min_lat, max_lon, max_lat)
+        return jsonify(city=city, bbox=[min_lon, min_lat, max_lon, max_lat], count=len(towns), towns=towns)
+
+    return server
@@ -0,0 +1,123 @@
+# time_series.py
+
+# 年次の人口データ（<市区町村名>_population_<年>.csv）による年ごとの比較
+# 年ごとの5歳階級×性別の人口を、町×年×年齢階級×性別の整数配列（キューブ）に1つにまとめる。
+# ジオメトリや町の並び順は元のデータセット（<市区町村名>_population.csv とシェイプファイルを結合したもの）のものを
+# そのまま使うので、年数が増えても増えるのは配列の値の分だけになる。
+# 地図で年を切り替えたときは、このキューブから求めた値の配列だけを送る（ジオメトリは送り直さない）
+
+import numpy as np  # 数値配列を扱うライブラリ
+import pandas as pd
+from data_loader import (get_derived, get_municipality_data, city_components, city_signature, population_years,
+                         population_file, read_population_csv, YEAR_FILE_PATTERN)
+from age_profiles import AGE_BINS, SEXES, SEX_INDEX, age_columns
+from bands import parse_band, band_membership, variable_values
+from derived_metrics import parse_metric, evaluate_metric, town_areas
+
+# 人口データの総数の列（年齢不詳を含むため5歳階級の合計とは一致しない場合がある）。配列の並び順
+TOTAL_COLUMNS = ['population_total', 'male_total', 'female_total']
+
+# 市 → (元データの状態, 年のスライダーの選択肢)。地図のコールバックのたびにデータのディレクトリを調べ直さないようにする
+_choices_cache = {}
+
+def city_years(city):
+    # 市区町村・組み合わせビューで年次データがある年（構成する市区町村のいずれかにある年）
+    return sorted(set().union(*(population_years(name) for name in city_components(city))))
+
+def year_choices(city):
+    # 年のスライダーの選択肢 [(年, ラベル), ...]。最後の「最新」（年が None）は年次でない人口データ
+    # （<市区町村名>_population.csv）を表す。年次のファイルしかない場合は最も新しい年が最新のデータになるので加えない
+    # 元データの状態（city_signature）が同じ間は前回の結果を使う
+    signature = city_signature(city)
+    cached = _choices_cache.get(city)
+    if cached is not None and cached[0] == signature:
+        return list(cached[1])
+    choices = _build_year_choices(city)
+    _choices_cache[city] = (signature, choices)
+    return list(choices)
+
+def _build_year_choices(city):
+    choices = [(year, f'{year}年') for year in city_years(city)]
+    has_latest = any(not YEAR_FILE_PATTERN.search(population_file(name)) for name in city_components(city))
+    if has_latest or not choices:
+        choices.append((None, '最新'))
+    return choices
+
+def _fill_municipality(cube, totals, present, town_names, name, years):
+    # 1つの市区町村の年次データを、その市区町村の行（town_names の並び）に書き込む
+    # 同じ町が複数の行（ポリゴン）に分かれている場合は、元のデータセットと同じくすべての行に同じ値を入れる
+    town_names = pd.Index(town_names.astype(object))
+    available = set(population_years(name))
+    for y, year in enumerate(years):
+        if year not in available:
+            continue
+        table = read_population_csv(population_file(name, year)).drop_duplicates('town_name')
+        positions = pd.Index(table['town_name']).get_indexer(town_names)
+        found = positions >= 0
+        present[found, y] = True
+        for s, (sex, _) in enumerate(SEXES):
+            values = table[age_columns(sex)].fillna(0).to_numpy(dtype=np.int64)
+            cube[found, y, :, s] = values[positions[found]]
+        values = table.reindex(columns=TOTAL_COLUMNS).fillna(0).to_numpy(dtype=np.int64)
+        totals[found, y, :] = values[positions[found]]
+
+def _build_year_cube(city, data):
+    years = city_years(city)
+    cube = np.zeros((len(data), len(years), len(AGE_BINS), len(SEXES)), dtype=np.int64)
+    totals = np.zeros((len(data), len(years), len(TOTAL_COLUMNS)), dtype=np.int64)
+    present = np.zeros((len(data), len(years)), dtype=bool)
+    # 組み合わせビューのデータは構成する市区町村のデータを順に結合したものなので、市区町村ごとに行の範囲を割り当てる
+    offset = 0
+    for name in city_components(city):
+        town_names = get_municipality_data(name)['town_name']
+        rows = slice(offset, offset + len(town_names))
+        _fill_municipality(cube[rows], totals[rows], present[rows], town_names, name, years)
+        offset += len(town_names)
+    if offset != len(data):
+        raise ValueError(f"{city} の行数が構成する市区町村の行数の合計と一致しません。")
+    # 人数は負にならないので、最大値が収まる最小の符号なし整数型にする
+    cube = cube.astype(np.min_scalar_type(int(cube.max()) if cube.size else 0))
+    totals = totals.astype(np.min_scalar_type(int(totals.max()) if totals.size else 0))
+    return {'years': years, 'year_index': {year: y for y, year in enumerate(years)},
+            'cube': cube, 'totals': totals, 'present': present}
+
+def year_cube(city):
+    # {'years': 年のリスト, 'year_index': 年→位置, 'cube': 町×年×年齢階級×性別の配列,
+    #  'totals': 町×年×総数の列（TOTAL_COLUMNS）の配列, 'present': 町×年のデータの有無}
+    # データセットごとにキャッシュされる
+    return get_derived(city, 'year_cube', lambda data: _build_year_cube(city, data))
+
+def _build_year_values(city, variable):
+    # すべての年の変数の値（町×年の float 配列）。その年のデータがない町は欠損値
+    # 総数の列はその列の値を、派生指標は各年の元の変数の値から、それ以外は年齢層として5歳階級の値から集計する
+    cube = year_cube(city)
+    if parse_metric(variable) is not None:
+        return evaluate_metric(variable, lambda v: year_values_all(city, v), town_areas(city))
+    if variable in TOTAL_COLUMNS:
+        values = cube['totals'][:, :, TOTAL_COLUMNS.index(variable)].astype(float)
+    else:
+        band = parse_band(variable)
+        if band is None:
+            raise KeyError(f"年次データで集計できない変数です: {variable}")
+        sex, lower, upper = band
+        values = (cube['cube'][:, :, :, SEX_INDEX[sex]] @ band_membership(lower, upper)).astype(float)
+    values[~cube['present']] = np.nan
+    return values
+
+def year_values_all(city, variable):
+    # 変数の町×年の値。データセット・変数ごとにメモ化される
+    return get_derived(city, ('year_values', variable), lambda data: _build_year_values(city, variable))
+
+def year_values(city, variable, year):
+    # 指定した年の変数の町ごとの値（データの行順、float配列）
+    cube = year_cube(city)
+    if year not in cube['year_index']:
+        raise KeyError(f"{year}年の人口データがありません: {city}")
+    return year_values_all(city, variable)[:, cube['year_index'][year]]
+
+def year_value_range(city, variable):
+    # すべての年と「最新」のデータを通した値の範囲。年を切り替えても色の基準が変わらないように地図の色の範囲に使う
+    values = np.concatenate([year_values_all(city, variable).ravel(), variable_values(city, variable)])
+    if np.isnan(values).all():
+        return None, None
+    return float(np.nanmin(values)), float(np.nanmax(values))
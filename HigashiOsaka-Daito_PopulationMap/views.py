@@ -0,0 +1,57 @@
+# views.py
+
+# 市区町村・組み合わせビューごとの地図の表示範囲（ビュー）の登録
+# 範囲（bbox）・投影座標系で求めた重心・画面に収まるズームをデータセットごとに一度だけ計算し、
+# コールバックではジオメトリの計算を行わずにこの値を使う
+
+import math
+
+import numpy as np  # 数値配列を扱うライブラリ
+import geopandas as gpd
+from data_loader import get_derived, PROJECTED_CRS
+
+# 地図（mapbox）のタイルのピクセル数。ズーム z で世界全体が TILE_SIZE * 2^z ピクセルになる
+TILE_SIZE = 512
+
+# ズームを合わせる地図の表示領域のおおよそのピクセル数（layout.py の mapPlot）
+MAP_VIEWPORT = {'width': 1100, 'height': 700}
+
+# 表示領域のうち、町の範囲が占める割合（周囲に少し余白を残す）
+VIEW_PADDING = 0.95
+
+def _mercator_y(lat):
+    return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+def fit_zoom(center, bounds, viewport=MAP_VIEWPORT, padding=VIEW_PADDING):
+    # center を中心にしたとき bounds (minx, miny, maxx, maxy) 全体が表示領域に収まる最大のズーム
+    minx, miny, maxx, maxy = bounds
+    lon_span = 2 * max(center['lon'] - minx, maxx - center['lon'])
+    y_center = _mercator_y(center['lat'])
+    y_span = 2 * max(y_center - _mercator_y(miny), _mercator_y(maxy) - y_center)
+    zooms = []
+    if lon_span > 0:
+        zooms.append(math.log2(viewport['width'] * padding * 360 / (TILE_SIZE * lon_span)))
+    if y_span > 0:
+        zooms.append(math.log2(viewport['height'] * padding * 2 * math.pi / (TILE_SIZE * y_span)))
+    return round(min(zooms), 2) if zooms else 12
+
+def _build_view(data):
+    geometry = data.geometry[data.geometry.notna()]
+    # 重心は投影座標系で各町の重心を面積で重み付け平均して求める（町の集合全体の重心と同じ）
+    projected = geometry.to_crs(PROJECTED_CRS)
+    areas = projected.area.to_numpy()
+    centroids = projected.centroid
+    x = float(np.average(centroids.x, weights=areas))
+    y = float(np.average(centroids.y, weights=areas))
+    centroid = gpd.points_from_xy([x], [y], crs=PROJECTED_CRS).to_crs(epsg=4326)[0]
+    center = {'lat': centroid.y, 'lon': centroid.x}
+    bounds = tuple(float(v) for v in geometry.total_bounds)
+    return {
+        'bounds': bounds,  # (西端の経度, 南端の緯度, 東端の経度, 北端の緯度)
+        'center': center,
+        'zoom': fit_zoom(center, bounds),
+    }
+
+def city_view(city):
+    # 市区町村・組み合わせビューの {'bounds', 'center', 'zoom'}。データセットごとにキャッシュされる
+    return get_derived(city, 'view', _build_view)
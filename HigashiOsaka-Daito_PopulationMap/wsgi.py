@@ -0,0 +1,27 @@
+# wsgi.py
+
+# 本番用のエントリーポイント（デバッグモード・ブラウザの自動起動なし）
+# gunicorn（Linux/macOS）: gunicorn -c gunicorn.conf.py wsgi:application
+#   preload_app により親プロセスでこのファイルを読み込み、データを作成してからワーカーを fork する
+# waitress など他のWSGIサーバー: waitress-serve --port=8050 wsgi:application
+# 単体で起動: python wsgi.py（waitress があれば waitress、なければFlaskのマルチスレッドサーバーで起動）
+
+import logging
+
+from app_factory import create_app
+from serving import HOST, PORT, THREADS, env_flag
+
+# POPMAP_PRELOAD=0 でデータの事前読み込みを省略（最初のリクエストで読み込む）
+dash_app = create_app(preload=env_flag('POPMAP_PRELOAD', True))
+application = dash_app.server
+
+if __name__ == '__main__':
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    logging.info("Serving on http://%s:%d/", HOST, PORT)
+    if serve is not None:
+        serve(application, host=HOST, port=PORT, threads=THREADS)
+    else:
+        application.run(host=HOST, port=PORT, debug=False, threaded=True)